@@ -1,16 +1,24 @@
+import logging
 import sys
 
 from dotenv import load_dotenv
-from PyQt5.QtWidgets import QApplication
+from PyQt5.QtWidgets import QApplication, QMessageBox
 
 from src.data_store import DataStore
+from src.logic.recovery import SessionInUseError
 from src.main_window import MainWindow
 
 if __name__ == "__main__":
     load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
 
     app = QApplication(sys.argv)
-    mw = MainWindow(DataStore())
+    try:
+        data_store = DataStore()
+    except SessionInUseError as e:
+        QMessageBox.critical(None, "Workset in use", str(e))
+        sys.exit(1)
+    mw = MainWindow(data_store)
     mw.show()
     mw.load_latest_sample()
     sys.exit(app.exec_())
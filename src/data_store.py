@@ -1,10 +1,26 @@
 import hashlib
 import json
+import logging
 import os
 import shutil
+import time
+from bisect import insort
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 
+import numpy as np
+
+from .logic.dedup import DUPLICATE_DISTANCE, DuplicateIndex
+from .logic.recovery import RecoveryJournal
+from .logic.sam_scheduler import CURRENT, IDLE, NEARBY, SamScheduler
 from .logic.segmentation import SegmentationModel
+from .logic.uncertainty import UncertaintyIndex, UncertaintyScorer
+from .logic.undo_journal import UndoJournal
+
+IMAGE_SETTLE_SECONDS = 2.0  # images still being copied are picked up later
+SAM_LOOKAHEAD = 3  # samples on each side of the current one run before the rest
+
+logger = logging.getLogger(__name__)
 
 
 class DataStore:
@@ -13,6 +29,7 @@ class DataStore:
         workset = os.environ["WORKSET"]
         accepted = os.environ["ACCEPTED"]
         segmentation_model_path = os.environ["SEGMENTATION_MODEL"]
+        self.roi_padding = int(os.environ.get("ROI_PADDING", "0"))
 
         self.workdir = top_work_dir / workset
         self.class_dir = top_work_dir / "classes.json"
@@ -25,17 +42,82 @@ class DataStore:
         self.roi_dir = self.workdir / "roi"
         self.label_dir.mkdir(exist_ok=True)
 
-        self.undo_history_dir = top_work_dir / "undo_history"
+        # refuses a workset open in another app before any journal is touched
+        self.recovery = RecoveryJournal(self.workdir / "recovery")
+        crashed = self.recovery.crashed
+        self.recovery.start_session()
+        if crashed:
+            recovered = self.recovery.replay_all(self.label_dir)
+            logger.info("recovered unsaved labels: %s", recovered)
+
+        # journals are keyed by image stem, so they live in the workset
+        shared_undo_dir = top_work_dir / "undo_history"
+        if shared_undo_dir.exists():
+            # left over from the former per-stroke PNGs and shared journals
+            for old_undo_file in [
+                *shared_undo_dir.glob("undo_*.png"),
+                *shared_undo_dir.glob("*.journal"),
+            ]:
+                old_undo_file.unlink()
+        self.undo_history_dir = self.workdir / "undo_history"
         self.undo_history_dir.mkdir(exist_ok=True)
-        self.curr_undo_index = 0
+        undo_history_mb = int(os.environ.get("UNDO_HISTORY_MB", "512"))
+        self.undo_journal = UndoJournal(
+            self.undo_history_dir, undo_history_mb * 1024 * 1024
+        )
 
         self.segmentation_model = (
-            SegmentationModel(segmentation_model_path)
+            SegmentationModel(
+                segmentation_model_path,
+                server_address=os.environ.get("INFERENCE_SERVER"),
+                server_authkey=os.environ.get("INFERENCE_AUTHKEY", "").encode(),
+            )
             if segmentation_model_path
             else None
         )
 
         self.current_image_path = None
+        # workset order, kept up to date incrementally by refresh_images()
+        self._images = []  # sorted by mtime
+        self._ranked_images = None  # frozen uncertainty order, see get_sorted_images
+        self._image_keys = {}  # name -> (inode, mtime, size)
+        self.has_settling_images = False
+        self.refresh_images(settle=False)
+        self._io_executor = ThreadPoolExecutor(max_workers=1)  # persists SAM results
+
+        # "mtime" (default) or "uncertainty" (active learning queue)
+        self.annotation_order = os.environ.get("ANNOTATION_ORDER", "mtime")
+        self.uncertainty_index = UncertaintyIndex(self.workdir / "uncertainty.json")
+        self.uncertainty_scorer = None
+        if self.annotation_order == "uncertainty" and self.segmentation_model:
+            self.uncertainty_scorer = UncertaintyScorer(
+                self.segmentation_model,
+                self.uncertainty_index,
+                self._unlabeled_images,
+            )
+            self.uncertainty_scorer.start()
+
+        # 新しい画像や前後のサンプルのSAMをバックグラウンドで事前に計算する
+        self.sam_scheduler = None
+        if os.environ.get("AUTO_SAM", "0") == "1" and self.segmentation_model:
+            self.sam_dir.mkdir(exist_ok=True)
+            self.sam_scheduler = SamScheduler(
+                self.segmentation_model, self.sam_dir, self.roi_dir, self.roi_padding
+            )
+            self.sam_scheduler.submit_many(self._unlabeled_images(), IDLE)
+            self.sam_scheduler.start()
+
+        # 承認済みとワークセットの画像の知覚ハッシュ (DUPLICATE_DISTANCE=0 で無効)
+        self.duplicate_distance = int(
+            os.environ.get("DUPLICATE_DISTANCE", DUPLICATE_DISTANCE)
+        )
+        self.duplicate_index = None
+        self._dedup_executor = ThreadPoolExecutor(max_workers=1)
+        if self.duplicate_distance > 0:
+            self.duplicate_index = DuplicateIndex(
+                top_work_dir / "duplicate_index.npz", top_work_dir
+            )
+            self._dedup_executor.submit(self._build_duplicate_index)
 
     def load_id2color(self) -> dict:
         with open(self.class_dir, "r") as f:
@@ -44,8 +126,135 @@ class DataStore:
         colors = [c["color"] for c in self.classes]
         return {k: v for k, v in zip(ids, colors)}
 
+    def refresh_images(self, settle: bool = True) -> tuple[list[Path], list[Path]]:
+        # only new names and replaced files (new inode, known from scandir
+        # without a stat) are stat'ed and (re)added; files overwritten in place
+        # are caught by check_image() when opened. settle: hold back files
+        # modified just now (probably still being copied)
+        now = time.time()
+        entries = {e.name: e for e in os.scandir(self.image_dir) if e.is_file()}
+        removed = [self.image_dir / n for n in self._image_keys.keys() - entries.keys()]
+        for image_path in removed:
+            self._remove_image(image_path)
+            if self._ranked_images is not None:
+                self._ranked_images.remove(image_path)
+
+        added = []
+        self.has_settling_images = False
+        for name, entry in entries.items():
+            known = self._image_keys.get(name)
+            if known is not None and known[0] == entry.inode():
+                continue
+            stat = entry.stat()
+            if settle and now - stat.st_mtime < IMAGE_SETTLE_SECONDS:
+                self.has_settling_images = True  # コピー中の可能性がある
+                continue
+            image_path = self.image_dir / name
+            self._set_image_key(
+                image_path, (entry.inode(), stat.st_mtime, stat.st_size)
+            )
+            added.append(image_path)
+        return added, removed
+
+    def check_image(self, image_path: Path) -> bool:
+        # True if the file was overwritten in place since it was listed
+        try:
+            stat = image_path.stat()
+        except FileNotFoundError:
+            return False
+        key = (stat.st_ino, stat.st_mtime, stat.st_size)
+        if self._image_keys.get(image_path.name, key) == key:
+            return False
+        self._set_image_key(image_path, key)
+        return True
+
+    def _set_image_key(self, image_path: Path, key: tuple[int, float, int]):
+        known = image_path.name in self._image_keys
+        if known:
+            self._remove_image(image_path)
+        self._image_keys[image_path.name] = key
+        insort(self._images, image_path, key=lambda p: self._image_keys[p.name][1])
+        if self._ranked_images is not None and not known:
+            self._ranked_images.append(image_path)  # 次の rerank まで末尾
+
+    def _remove_image(self, image_path: Path):
+        del self._image_keys[image_path.name]
+        self._images.remove(image_path)
+
+    def schedule_sam(self, image_paths: list[Path]):
+        if self.sam_scheduler is not None:
+            self.sam_scheduler.submit_many(image_paths, IDLE)
+
+    def schedule_uncertainty(self, image_paths: list[Path]):
+        if self.uncertainty_scorer is not None and image_paths:
+            self.uncertainty_scorer.wake()
+
+    def schedule_sam_around(self, image_path: Path):
+        if self.sam_scheduler is None:
+            return
+        self.sam_scheduler.submit(image_path, CURRENT)
+        images = self.get_sorted_images()
+        if image_path not in images:
+            return
+        index = images.index(image_path)
+        for offset in range(1, SAM_LOOKAHEAD + 1):
+            for neighbor in (index + offset, index - offset):
+                if 0 <= neighbor < len(images):
+                    self.sam_scheduler.submit(images[neighbor], NEARBY)
+
+    def _build_duplicate_index(self):
+        try:
+            self.duplicate_index.refresh([self.accepted_image_dir, self.image_dir])
+            self.duplicate_index.save()
+        except (OSError, ValueError) as e:
+            logger.warning("failed to build the duplicate index: %s", e)
+
+    def index_duplicates(self, added: list[Path], removed: list[Path]):
+        if self.duplicate_index is None:
+            return
+        for image_path in removed:
+            self._dedup_executor.submit(self.duplicate_index.remove, image_path)
+        for image_path in added:
+            self._dedup_executor.submit(self.duplicate_index.add, image_path)
+        self._dedup_executor.submit(self.duplicate_index.compact)
+
     def get_sorted_images(self):
-        return sorted(self.image_dir.iterdir(), key=lambda p: p.stat().st_mtime)
+        if self.annotation_order != "uncertainty":
+            return list(self._images)
+        # 並びはセッション開始時 (または rerank_images() の時点) で固定し、
+        # 保存のたびに前後の画像が入れ替わらないようにする
+        if self._ranked_images is None:
+            self._ranked_images = self._rank_images()
+        return list(self._ranked_images)
+
+    def rerank_images(self):
+        self._ranked_images = None
+
+    def _rank_images(self) -> list[Path]:
+        images = list(self._images)
+        # 未ラベルの画像を不確かさの高い順に先頭へ、ラベル済みと未スコアは末尾
+        # (スコアはラベル付け後も保持される)
+        labeled = {e.name for e in os.scandir(self.label_dir)}
+        scores = {
+            p: self.uncertainty_index.get(p, self._image_keys[p.name][1])
+            for p in images
+            if p.stem + ".png" not in labeled
+        }
+        queue = sorted((p for p in scores if scores[p] is not None), key=scores.get)
+        queue.reverse()
+        queued = set(queue)
+        return queue + [p for p in images if p not in queued]
+
+    def get_initial_image(self) -> Path:
+        images = self.get_sorted_images()
+        return images[0] if self.annotation_order == "uncertainty" else images[-1]
+
+    def _unlabeled_images(self) -> list[Path]:
+        return [
+            p
+            for p in reversed(list(self._images))
+            if not (self.label_dir / (p.stem + ".png")).exists()
+        ]
 
     def get_current_label_path(self) -> Path:
         return self.label_dir / (self.current_image_path.stem + ".png")
@@ -56,17 +265,42 @@ class DataStore:
     def get_current_roi_path(self):
         return self.roi_dir / (self.current_image_path.stem + ".png")
 
-    def transfer_image_to_accept(self, label_saver):
-        # get hash value  of the image
+    def _accepted_image_path(self) -> Path:
+        # accepted images are named by the MD5 of their bytes
         with open(self.current_image_path, "rb") as f:
-            bytes = f.read()
-            hash_val = hashlib.md5(bytes).hexdigest()
-            print("hash value:", hash_val)
+            hash_val = hashlib.md5(f.read()).hexdigest()
+        return self.accepted_image_dir / f"{hash_val}{self.current_image_path.suffix}"
 
-        shutil.copy(
-            self.current_image_path,
-            self.accepted_image_dir / f"{hash_val}{self.current_image_path.suffix}",
-        )
+    def find_near_duplicates(self) -> list[tuple[Path, int]]:
+        # accepted images that look like the current one, nearest first;
+        # its own copy from an earlier accept is not reported
+        if self.duplicate_index is None:
+            return []
+        value = self.duplicate_index.hash_of(self.current_image_path)
+        if value is None:
+            return []
+        own = self.duplicate_index.key(self._accepted_image_path())
+        prefix = self.duplicate_index.key(self.accepted_image_dir) + "/"
+        return [
+            (self.duplicate_index.root / key, distance)
+            for key, distance in self.duplicate_index.query(
+                value, self.duplicate_distance
+            )
+            if key.startswith(prefix) and key != own
+        ]
+
+    def transfer_image_to_accept(self, label_saver):
+        accepted_image_path = self._accepted_image_path()
+        hash_val = accepted_image_path.stem
+        print("hash value:", hash_val)
+
+        shutil.copy(self.current_image_path, accepted_image_path)
+        if self.duplicate_index is not None:
+            self.duplicate_index.add(
+                accepted_image_path,
+                self.duplicate_index.hash_of(self.current_image_path),
+            )
+            self._dedup_executor.submit(self.duplicate_index.compact)
 
         shutil.copy(
             self.get_current_roi_path(), self.accepted_roi_dir / f"{hash_val}.png"
@@ -75,39 +309,58 @@ class DataStore:
         label_path = self.accepted_label_dir / (hash_val + ".png")
         label_saver(label_path)
 
-    def run_sam(self):
+    def run_sam(self) -> tuple[Path, np.ndarray, list[dict], Future]:
         if self.segmentation_model is None:
             raise ValueError
         print("SAM run button clicked")
 
         sam_path = self.sam_dir / (self.current_image_path.stem + ".png")
-        self.segmentation_model.segment_image(self.current_image_path, sam_path)
-        return sam_path
+        labeled_image, instances = self.segmentation_model.segment(
+            self.current_image_path,
+            roi_path=self.get_current_roi_path(),
+            roi_padding=self.roi_padding,
+        )
+        # 表示は配列から直接行い、PNGとjsonの保存はバックグラウンドで行う
+        future = self._io_executor.submit(
+            SegmentationModel.save_segmentation, sam_path, labeled_image, instances
+        )
+        future.add_done_callback(self._report_io_error)
+        return sam_path, labeled_image, instances, future
 
-    def reset_undo_history(self):
-        if self.undo_history_dir.exists():
-            shutil.rmtree(self.undo_history_dir)
-        self.undo_history_dir.mkdir(exist_ok=True)
-        self.curr_undo_index = -1
-
-    def save_undo_state(self):
-        self.curr_undo_index += 1
-        undo_file = self.undo_history_dir / f"undo_{self.curr_undo_index}.png"
-        return undo_file
-
-    def undo(self) -> Path | None:
-        print("Undo operation triggered", self.curr_undo_index)
-        if self.curr_undo_index > 0:
-            self.curr_undo_index -= 1
-            undo_file = self.undo_history_dir / f"undo_{self.curr_undo_index}.png"
-            if undo_file.exists():
-                return undo_file
-        return None
-
-    def redo(self) -> Path | None:
-        redo_file = self.undo_history_dir / f"undo_{self.curr_undo_index + 1}.png"
-        if redo_file.exists():
-            self.curr_undo_index += 1
-            return redo_file
-
-        return None
+    @staticmethod
+    def _report_io_error(future):
+        if future.exception() is not None:
+            logger.error("failed to save SAM result: %s", future.exception())
+
+    def autosave_label(self, shape: tuple[int, int], tiles: list):
+        if tiles:
+            self.recovery.append(self.current_image_path.stem, shape, tiles)
+
+    def mark_label_saved(self):
+        self.recovery.discard(self.current_image_path.stem)
+
+    def close(self):
+        if self.uncertainty_scorer is not None:
+            self.uncertainty_scorer.stop()
+        if self.sam_scheduler is not None:
+            self.sam_scheduler.stop()
+        self._io_executor.shutdown(wait=True)
+        self._dedup_executor.shutdown(wait=True)
+        if self.duplicate_index is not None:
+            self.duplicate_index.save()
+        self.recovery.end_session()
+
+    def open_undo_history(self, packed_label: np.ndarray):
+        self.undo_journal.open(self.current_image_path.stem, packed_label)
+
+    def save_undo_state(
+        self, packed_label: np.ndarray, rect: tuple[int, int, int, int] | None
+    ):
+        self.undo_journal.record(packed_label, rect)
+
+    def undo(self) -> tuple[int, int, np.ndarray] | None:
+        print("Undo operation triggered")
+        return self.undo_journal.undo()
+
+    def redo(self) -> tuple[int, int, np.ndarray] | None:
+        return self.undo_journal.redo()
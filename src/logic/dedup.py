@@ -0,0 +1,338 @@
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations, pairwise
+from pathlib import Path
+
+import cv2
+import numpy as np
+from dotenv import load_dotenv
+
+DUPLICATE_DISTANCE = 8  # bits of 64; re-encoding and resizing stay within ~2
+REBUILD_AFTER = 4096  # entries added since the last build that are scanned linearly
+
+logger = logging.getLogger(__name__)
+
+
+def dhash(path: Path) -> int | None:
+    # 64-bit difference hash of the 9x8 grayscale thumbnail
+    image = cv2.imread(str(path), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if image is None:
+        return None
+    small = cv2.resize(image, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def hash_files(paths: list[Path], workers: int | None = None) -> list[int | None]:
+    if len(paths) < 256:
+        return [dhash(p) for p in paths]
+    # threads: decoding releases the GIL, and this also runs inside the GUI
+    # process, where worker processes would have to import it all again
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(dhash, paths))
+
+
+def _flip_masks(width: int, flips: int) -> np.ndarray:
+    # every value with at most `flips` of the low `width` bits set
+    masks = [0]
+    for n in range(1, flips + 1):
+        masks += [sum(1 << b for b in bits) for bits in combinations(range(width), n)]
+    return np.array(masks, dtype=np.uint64)
+
+
+class HammingIndex:
+    """Multi-index hashing over 64-bit hashes for Hamming radius queries.
+
+    The hashes are split into parts of about log2(n) bits, each with a
+    bucket table. Two hashes within distance r differ in at most
+    r // parts bits in at least one part, so only the buckets reached by
+    flipping that many bits are verified instead of every entry.
+    """
+
+    def __init__(self, hashes: np.ndarray):
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        n = max(2, len(self.hashes))
+        self.parts = min(8, max(3, round(64 / math.log2(n))))
+        bounds = np.linspace(0, 64, self.parts + 1).astype(int)
+        self._tables = []  # (shift, width, bucket starts, entry order)
+        for lo, hi in pairwise(bounds):
+            values = self._part(self.hashes, lo, hi - lo)
+            order = np.argsort(values, kind="stable").astype(np.int64)
+            starts = np.searchsorted(
+                values[order], np.arange((1 << (hi - lo)) + 1, dtype=np.uint64)
+            )
+            self._tables.append((lo, hi - lo, starts, order))
+
+    @staticmethod
+    def _part(hashes: np.ndarray, shift: int, width: int) -> np.ndarray:
+        return (hashes >> np.uint64(shift)) & np.uint64((1 << width) - 1)
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def search(
+        self, queries: np.ndarray, radius: int
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # (query index, entry index, distance) of every match, each pair once
+        queries = np.asarray(queries, dtype=np.uint64)
+        found = []
+        for shift, width, starts, order in self._tables:
+            part = self._part(queries, shift, width)
+            for flip in _flip_masks(width, radius // self.parts):
+                bucket = (part ^ flip).astype(np.int64)
+                begin, counts = starts[bucket], starts[bucket + 1] - starts[bucket]
+                if not counts.any():
+                    continue
+                q = np.repeat(np.arange(len(queries)), counts)
+                offsets = np.arange(len(q)) - np.repeat(
+                    np.cumsum(counts) - counts, counts
+                )
+                e = order[np.repeat(begin, counts) + offsets]
+                close = np.bitwise_count(queries[q] ^ self.hashes[e]) <= radius
+                found.append(q[close] * len(self.hashes) + e[close])
+        if not found:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty
+        pairs = np.unique(np.concatenate(found))
+        q, e = np.divmod(pairs, len(self.hashes))
+        return q, e, np.bitwise_count(queries[q] ^ self.hashes[e]).astype(np.int64)
+
+
+class DuplicateIndex:
+    """Persistent dHash of every image under `root`, by relative path.
+
+    Entries are invalidated by mtime like UncertaintyIndex. Images added
+    after the last HammingIndex build are kept aside and compared linearly
+    until compact() finds REBUILD_AFTER of them. Builds happen outside the
+    lock, so queries are not held up by them.
+    """
+
+    def __init__(self, path: Path, root: Path):
+        self.path = path
+        self.root = root
+        self._lock = threading.Lock()
+        self._entries = {}  # relative path -> (mtime, hash)
+        self._index = None
+        self._index_keys = []
+        self._recent = {}  # relative path -> hash, not in _index yet
+        if path.exists():
+            self._load()
+
+    def _load(self):
+        # a broken file only costs re-hashing everything
+        try:
+            with np.load(self.path) as data:
+                raw_keys = data["keys"]
+                keys = bytes(raw_keys).decode().split("\n") if raw_keys.size else []
+                for key, mtime, value in zip(keys, data["mtimes"], data["hashes"]):
+                    self._entries[key] = (float(mtime), int(value))
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            logger.warning("ignored %s: %s", self.path.name, e)
+            self._entries = {}
+
+    def save(self):
+        with self._lock:
+            keys = list(self._entries)
+            mtimes = np.array([self._entries[k][0] for k in keys], dtype=np.float64)
+            hashes = np.array([self._entries[k][1] for k in keys], dtype=np.uint64)
+        tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                keys=np.frombuffer("\n".join(keys).encode(), dtype=np.uint8),
+                mtimes=mtimes,
+                hashes=hashes,
+            )
+        os.replace(tmp_path, self.path)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def key(self, path: Path) -> str:
+        return path.relative_to(self.root).as_posix()
+
+    def refresh(self, dirs: list[Path], workers: int | None = None) -> tuple[int, int]:
+        # (hashed, removed); only new or modified files are decoded
+        current = {}
+        for d in dirs:
+            if d.exists():
+                for entry in os.scandir(d):
+                    if entry.is_file():
+                        current[self.key(Path(entry.path))] = entry.stat().st_mtime
+        prefixes = tuple(self.key(d) + "/" for d in dirs)
+        with self._lock:
+            removed = [
+                k for k in self._entries if k.startswith(prefixes) and k not in current
+            ]
+            stale = [
+                k for k, m in current.items() if self._entries.get(k, (0,))[0] != m
+            ]
+        for key in removed:
+            self.remove(self.root / key)
+
+        start = time.perf_counter()
+        values = hash_files([self.root / k for k in stale], workers)
+        with self._lock:
+            for key, value in zip(stale, values):
+                self._entries.pop(key, None)
+                if value is not None:
+                    self._entries[key] = (current[key], value)
+        self._rebuild()
+        if stale:
+            elapsed = time.perf_counter() - start
+            logger.info("hashed %d images in %.1fs", len(stale), elapsed)
+        return len(stale), len(removed)
+
+    def _rebuild(self):
+        with self._lock:
+            keys = list(self._entries)
+            hashes = [self._entries[k][1] for k in keys]
+            recent = dict(self._recent)
+        index = HammingIndex(hashes)
+        with self._lock:
+            self._index, self._index_keys = index, keys
+            for key, value in recent.items():
+                if self._recent.get(key) == value:  # not re-added meanwhile
+                    del self._recent[key]
+
+    def compact(self):
+        # folds the linearly compared recent entries into the index once there
+        # are enough of them; meant for a background thread
+        if len(self._recent) > REBUILD_AFTER:
+            self._rebuild()
+
+    def hash_of(self, path: Path) -> int | None:
+        mtime = path.stat().st_mtime
+        with self._lock:
+            entry = self._entries.get(self.key(path))
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        return dhash(path)
+
+    def add(self, path: Path, value: int | None = None):
+        if value is None:
+            value = dhash(path)
+            if value is None:
+                return
+        key = self.key(path)
+        with self._lock:
+            self._entries[key] = (path.stat().st_mtime, value)
+            self._recent[key] = value
+
+    def remove(self, path: Path):
+        with self._lock:
+            self._entries.pop(self.key(path), None)
+            self._recent.pop(self.key(path), None)
+
+    def query(self, value: int, radius: int) -> list[tuple[str, int]]:
+        # [(relative path, distance)] nearest first
+        with self._lock:
+            matches = {}
+            if self._index is not None and len(self._index):
+                _, found, distances = self._index.search([value], radius)
+                for i, distance in zip(found, distances):
+                    matches[self._index_keys[i]] = int(distance)
+            for key, other in self._recent.items():
+                distance = (value ^ other).bit_count()
+                if distance <= radius:
+                    matches[key] = distance
+            # removed or re-hashed since the last build
+            matches = {
+                k: d
+                for k, d in matches.items()
+                if k in self._entries and (self._entries[k][1] ^ value).bit_count() == d
+            }
+        return sorted(matches.items(), key=lambda item: (item[1], item[0]))
+
+    def clusters(self, radius: int) -> list[list[str]]:
+        # connected groups of images within `radius` of one another
+        with self._lock:
+            keys = list(self._entries)
+            hashes = np.array([self._entries[k][1] for k in keys], dtype=np.uint64)
+        index = HammingIndex(hashes)
+        parent = np.arange(len(keys))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        batch = 1 << 16
+        for begin in range(0, len(keys), batch):
+            q, e, _ = index.search(hashes[begin : begin + batch], radius)
+            q += begin
+            for a, b in zip(q[q < e].tolist(), e[q < e].tolist()):
+                ra, rb = find(a), find(b)
+                if ra != rb:
+                    parent[max(ra, rb)] = min(ra, rb)
+
+        groups = {}
+        for i in range(len(keys)):
+            groups.setdefault(find(i), []).append(keys[i])
+        return sorted((g for g in groups.values() if len(g) > 1), key=len, reverse=True)
+
+
+def _distinct_copies(root: Path, cluster: list[str]) -> list[str]:
+    # a workset image and its accepted copy are the same bytes, keep one
+    seen = {}
+    for key in cluster:
+        seen.setdefault(hashlib.md5((root / key).read_bytes()).hexdigest(), key)
+    return list(seen.values())
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    parser = argparse.ArgumentParser(
+        description="Report clusters of near-duplicate images in the accepted set"
+        " and the workset"
+    )
+    parser.add_argument(
+        "--distance",
+        type=int,
+        default=int(os.environ.get("DUPLICATE_DISTANCE", DUPLICATE_DISTANCE)),
+        help="max differing bits of the 64-bit dHash",
+    )
+    parser.add_argument("--report", type=Path, default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    top_work_dir = Path(os.environ["TOP_WORK_DIR"]).expanduser()
+    index = DuplicateIndex(top_work_dir / "duplicate_index.npz", top_work_dir)
+    index.refresh(
+        [
+            top_work_dir / os.environ["ACCEPTED"] / "images",
+            top_work_dir / os.environ["WORKSET"] / "images",
+        ],
+        args.workers,
+    )
+    index.save()
+
+    start = time.perf_counter()
+    clusters = [
+        _distinct_copies(top_work_dir, c) for c in index.clusters(args.distance)
+    ]
+    clusters = [c for c in clusters if len(c) > 1]
+    elapsed = time.perf_counter() - start
+    duplicates = sum(len(c) - 1 for c in clusters)
+    print(
+        f"{len(clusters)} clusters, {duplicates} redundant of {len(index)} images"
+        f" (distance <= {args.distance}, {elapsed:.1f}s)"
+    )
+    report_path = args.report or top_work_dir / "duplicate_report.jsonl"
+    with open(report_path, "w") as report:
+        report.writelines(
+            json.dumps({"size": len(cluster), "images": cluster}) + "\n"
+            for cluster in clusters
+        )
+    print("report written to", report_path)
@@ -0,0 +1,181 @@
+import argparse
+import io
+import json
+import os
+import tarfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import cv2
+from dotenv import load_dotenv
+
+from .palette import colors_to_ids, load_id2color
+
+INDEX_FILE = "index.json"
+
+
+def _encode_sample(args) -> tuple[str, list[tuple[str, bytes]]] | None:
+    image_path, label_path, roi_path, id2color = args
+    hash_val = image_path.stem
+
+    label = cv2.imread(str(label_path), cv2.IMREAD_UNCHANGED)
+    if label is None:
+        print("skip (no label):", image_path.name)
+        return None
+    ok, label_png = cv2.imencode(".png", colors_to_ids(label, id2color))
+    if not ok:
+        print("skip (label encode failed):", image_path.name)
+        return None
+
+    # 画像とROIは再エンコードせずにそのまま格納する
+    members = [
+        (f"{hash_val}{image_path.suffix.lower()}", image_path.read_bytes()),
+        (f"{hash_val}.label.png", label_png.tobytes()),
+    ]
+    if roi_path.exists():
+        members.append((f"{hash_val}.roi.png", roi_path.read_bytes()))
+    return hash_val, members
+
+
+def _imap_bounded(executor, fn, items, window: int):
+    # like executor.map, but keeps only `window` tasks in flight
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class ShardExporter:
+    def __init__(self, accepted_dir: Path, class_path: Path, out_dir: Path):
+        self.image_dir = accepted_dir / "images"
+        self.label_dir = accepted_dir / "labels"
+        self.roi_dir = accepted_dir / "roi"
+        self.out_dir = out_dir
+        self.id2color = load_id2color(class_path)
+
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.out_dir / INDEX_FILE
+        self.index = self._load_index()
+
+    def _load_index(self) -> dict:
+        index = {"shards": [], "samples": {}}
+        if self.index_path.exists():
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+        # shards finished by a run that was interrupted before merging them
+        indexed = {shard["name"] for shard in index["shards"]}
+        for manifest_path in self._shard_manifests():
+            with open(manifest_path, "r") as f:
+                manifest = json.load(f)
+            if manifest["name"] not in indexed:
+                self._add_to_index(index, manifest["name"], manifest["samples"])
+        return index
+
+    def _shard_manifests(self) -> list[Path]:
+        return sorted(self.out_dir.glob("shard-*.json"))
+
+    @staticmethod
+    def _add_to_index(index: dict, name: str, hashes: list[str]):
+        index["shards"].append({"name": name, "samples": len(hashes)})
+        for hash_val in hashes:
+            index["samples"][hash_val] = name
+
+    @staticmethod
+    def _write_json(path: Path, data):
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def _save_index(self):
+        # index.json is written once per run; each shard has its own small
+        # manifest until then, so the run can be interrupted at any point
+        self._write_json(self.index_path, self.index)
+        for manifest_path in self._shard_manifests():
+            manifest_path.unlink()
+
+    def _pending_samples(self):
+        known = self.index["samples"]
+        for image_path in sorted(self.image_dir.iterdir()):
+            if image_path.stem in known:
+                continue
+            yield (
+                image_path,
+                self.label_dir / f"{image_path.stem}.png",
+                self.roi_dir / f"{image_path.stem}.png",
+                self.id2color,
+            )
+
+    def _open_shard(self) -> tuple[str, tarfile.TarFile]:
+        # a shard left over from an interrupted run is not indexed and is rewritten
+        name = f"shard-{len(self.index['shards']):06d}.tar"
+        return name, tarfile.open(self.out_dir / name, "w")
+
+    def _close_shard(self, name: str, tar: tarfile.TarFile, hashes: list[str]):
+        tar.close()
+        manifest_path = (self.out_dir / name).with_suffix(".json")
+        self._write_json(manifest_path, {"name": name, "samples": hashes})
+        self._add_to_index(self.index, name, hashes)
+        print(f"wrote {name} ({len(hashes)} samples)")
+
+    def export(self, shard_size: int, workers: int | None = None) -> int:
+        start = time.perf_counter()
+        exported = 0
+        name, tar, hashes = None, None, []
+
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            window = 4 * workers
+            for result in _imap_bounded(
+                executor, _encode_sample, self._pending_samples(), window
+            ):
+                if result is None:
+                    continue
+                if tar is None:
+                    name, tar = self._open_shard()
+
+                hash_val, members = result
+                for member_name, data in members:
+                    info = tarfile.TarInfo(member_name)
+                    info.size = len(data)
+                    info.mtime = int(time.time())
+                    tar.addfile(info, io.BytesIO(data))
+                hashes.append(hash_val)
+                exported += 1
+
+                if len(hashes) >= shard_size:
+                    self._close_shard(name, tar, hashes)
+                    name, tar, hashes = None, None, []
+
+        if tar is not None:
+            self._close_shard(name, tar, hashes)
+        self._save_index()
+
+        elapsed = time.perf_counter() - start
+        print(f"exported {exported} new samples in {elapsed:.1f}s")
+        return exported
+
+
+if __name__ == "__main__":
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(
+        description="Export the accepted set into tar shards for training"
+    )
+    parser.add_argument("out_dir", type=Path)
+    parser.add_argument("--shard-size", type=int, default=1000, help="samples/shard")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    top_work_dir = Path(os.environ["TOP_WORK_DIR"]).expanduser()
+    exporter = ShardExporter(
+        top_work_dir / os.environ["ACCEPTED"],
+        top_work_dir / "classes.json",
+        args.out_dir,
+    )
+    exporter.export(args.shard_size, args.workers)
@@ -0,0 +1,113 @@
+import tempfile
+import threading
+from multiprocessing.connection import Client
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+
+import numpy as np
+
+# (class ids (n,), confidences (n,), masks at model resolution (n, mh, mw))
+RawPrediction = tuple[np.ndarray, np.ndarray, np.ndarray]
+
+# (shape, dtype, byte offset) of each array in a shared memory block
+ArrayMeta = tuple[tuple[int, ...], str, int]
+
+
+# used by the server when INFERENCE_SERVER is not set; never listens beyond
+# this machine
+DEFAULT_ADDRESS = str(Path(tempfile.gettempdir()) / "image-sat.sock")
+
+
+def parse_address(address: str) -> str | tuple[str, int]:
+    # "host:port" for TCP, anything else is a Unix socket path
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit():
+        return host, int(port)
+    return address
+
+
+def write_arrays(
+    arrays: list[np.ndarray],
+) -> tuple[SharedMemory | None, list[ArrayMeta]]:
+    metas = []
+    offset = 0
+    for array in arrays:
+        metas.append((array.shape, array.dtype.str, offset))
+        offset += array.nbytes
+    if offset == 0:
+        return None, metas
+
+    shm = SharedMemory(create=True, size=offset)  # unlinked by the creator
+    for array, (shape, dtype, offset) in zip(arrays, metas):
+        np.ndarray(shape, dtype, buffer=shm.buf, offset=offset)[...] = array
+    return shm, metas
+
+
+def read_arrays(name: str | None, metas: list[ArrayMeta]) -> list[np.ndarray]:
+    # copies, so the block can be released right away
+    if name is None:
+        return [np.zeros(shape, dtype) for shape, dtype, _ in metas]
+    shm = SharedMemory(name=name, track=False)  # owned by the other process
+    try:
+        return [
+            np.ndarray(shape, dtype, buffer=shm.buf, offset=offset).copy()
+            for shape, dtype, offset in metas
+        ]
+    finally:
+        shm.close()
+
+
+def release(shm: SharedMemory | None):
+    if shm is not None:
+        shm.close()
+        shm.unlink()
+
+
+class InferenceClient:
+    """Sends images to a local InferenceServer instead of loading the model.
+
+    Pixels and masks go through shared memory; only names, shapes and
+    scores are pickled over the connection. Each thread has its own
+    connection, so requests from the GUI and background workers can end up
+    in the same server-side batch.
+    """
+
+    def __init__(self, address: str, authkey: bytes):
+        self.address = parse_address(address)
+        self.authkey = authkey
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = Client(self.address, authkey=self.authkey)
+            self._local.conn = conn
+        return conn
+
+    def infer(self, images: list[np.ndarray]) -> list[RawPrediction]:
+        shm, metas = write_arrays(images)
+        conn = None
+        try:
+            conn = self._connection()
+            conn.send(("infer", shm.name if shm else None, metas))
+            reply = conn.recv()
+        except BaseException:
+            # the reply may still be in flight: drop the connection, reconnect
+            # on the next call
+            self._local.conn = None
+            if conn is not None:
+                conn.close()
+            raise
+        finally:
+            release(shm)
+
+        if reply[0] == "error":
+            raise RuntimeError(f"inference server: {reply[1]}")
+        _, name, predictions = reply
+        masks = read_arrays(name, [meta for _, _, meta in predictions])
+        if name is not None:
+            conn.send(("release", name))  # no reply, the server frees the block
+        return [
+            (np.array(classes, dtype=np.int64), np.array(confs, dtype=np.float32), m)
+            for (classes, confs, _), m in zip(predictions, masks)
+        ]
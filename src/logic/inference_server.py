@@ -0,0 +1,192 @@
+import argparse
+import ipaddress
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+from .inference_client import (
+    DEFAULT_ADDRESS,
+    parse_address,
+    read_arrays,
+    release,
+    write_arrays,
+)
+from .segmentation import SegmentationModel
+
+logger = logging.getLogger(__name__)
+
+
+def _is_loopback(host: str) -> bool:
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+class _Request:
+    def __init__(self, images: list):
+        self.images = images
+        self.predictions = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class InferenceServer:
+    """Loads the model once and serves several annotator processes.
+
+    Requests arriving within `max_latency` of the first one in a batch are
+    run together, up to `max_batch` images. Result masks are written to a
+    shared memory block per reply, which the client releases once it has
+    copied them (or the server does when the client disconnects).
+    """
+
+    def __init__(
+        self,
+        model: SegmentationModel,
+        address: str,
+        authkey: bytes,
+        max_batch: int = 8,
+        max_latency: float = 0.01,
+    ):
+        self.model = model
+        self.address = parse_address(address)
+        self.authkey = authkey
+        if not authkey:
+            raise ValueError("an empty authkey would let any local process in")
+        if isinstance(self.address, tuple) and not _is_loopback(self.address[0]):
+            # masks are passed through shared memory, remote clients cannot work
+            raise ValueError(f"refusing to listen on non-loopback {self.address[0]}")
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self._queue = queue.Queue()
+
+    def serve_forever(self):
+        if isinstance(self.address, str) and Path(self.address).exists():
+            Path(self.address).unlink()  # left over from a server that crashed
+        threading.Thread(target=self._batch_loop, daemon=True).start()
+        with Listener(self.address, authkey=self.authkey) as listener:
+            print("inference server listening on", self.address)
+            while True:
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, OSError) as e:
+                    print("rejected client:", e)
+                    continue
+                threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        owned = {}  # reply blocks not yet released by this client
+        try:
+            while True:
+                message = conn.recv()
+                if message[0] == "release":
+                    release(owned.pop(message[1], None))
+                    continue
+
+                _, name, metas = message
+                request = _Request(read_arrays(name, metas))
+                self._queue.put(request)
+                request.done.wait()
+                if request.error is not None:
+                    conn.send(("error", request.error))
+                    continue
+
+                shm, mask_metas = write_arrays([m for _, _, m in request.predictions])
+                if shm is not None:
+                    owned[shm.name] = shm
+                conn.send(
+                    (
+                        "ok",
+                        shm.name if shm else None,
+                        [
+                            (classes.tolist(), confs.tolist(), meta)
+                            for (classes, confs, _), meta in zip(
+                                request.predictions, mask_metas
+                            )
+                        ],
+                    )
+                )
+        except (EOFError, OSError):
+            pass  # client went away
+        finally:
+            for shm in owned.values():
+                release(shm)
+            conn.close()
+
+    def _next_batch(self) -> list[_Request]:
+        batch = [self._queue.get()]
+        n_images = len(batch[0].images)
+        deadline = time.monotonic() + self.max_latency
+        while n_images < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            n_images += len(request.images)
+        return batch
+
+    def _batch_loop(self):
+        while True:
+            batch = self._next_batch()
+            images = [image for request in batch for image in request.images]
+            start = time.perf_counter()
+            try:
+                predictions = self.model.infer_raw(images)
+            except Exception as e:
+                # reported to every client of the batch, the server keeps going
+                logger.exception("inference failed for %d images", len(images))
+                for request in batch:
+                    request.error = str(e)
+                    request.done.set()
+                continue
+            elapsed = time.perf_counter() - start
+            print(
+                f"batch: {len(images)} images from {len(batch)} requests"
+                f" in {elapsed * 1000:.0f} ms"
+            )
+
+            for request in batch:
+                request.predictions = predictions[: len(request.images)]
+                predictions = predictions[len(request.images) :]
+                request.done.set()
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(
+        description="Serve the segmentation model to local annotator processes"
+    )
+    parser.add_argument("--max-batch", type=int, default=8)
+    parser.add_argument(
+        "--max-latency-ms",
+        type=float,
+        default=10,
+        help="how long the first request of a batch waits for others",
+    )
+    args = parser.parse_args()
+
+    try:
+        server = InferenceServer(
+            SegmentationModel(os.environ["SEGMENTATION_MODEL"]),
+            os.environ.get("INFERENCE_SERVER") or DEFAULT_ADDRESS,
+            os.environ.get("INFERENCE_AUTHKEY", "").encode(),
+            max_batch=args.max_batch,
+            max_latency=args.max_latency_ms / 1000,
+        )
+    except ValueError as e:
+        parser.error(f"{e} (check INFERENCE_SERVER and INFERENCE_AUTHKEY)")
+    server.serve_forever()
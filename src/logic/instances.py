@@ -0,0 +1,64 @@
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+
+def encode_rle(mask: np.ndarray) -> list[int]:
+    # row-major run lengths, always starting with a (possibly empty) run of zeros
+    flat = mask.ravel()
+    if flat.size == 0:
+        return []
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat[0]:
+        counts = np.concatenate(([0], counts))
+    return counts.tolist()
+
+
+def decode_rle(counts: list[int], shape: tuple[int, int]) -> np.ndarray:
+    values = np.zeros(len(counts), dtype=bool)
+    values[1::2] = True
+    return np.repeat(values, counts).reshape(shape)
+
+
+def rle_contains(run_ends: np.ndarray, index: int) -> bool:
+    # run_ends = np.cumsum(counts); odd runs are foreground
+    return bool(np.searchsorted(run_ends, index, side="right") % 2)
+
+
+def encode_instance(
+    class_id: int, score: float, mask: np.ndarray, x0: int = 0, y0: int = 0
+) -> dict | None:
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return None
+    top, bottom = rows[0], rows[-1] + 1
+    cols = np.flatnonzero(mask[top:bottom].any(axis=0))
+    left, right = cols[0], cols[-1] + 1
+
+    return {
+        "class_id": int(class_id),
+        "score": round(float(score), 4),
+        "bbox": [int(x0 + left), int(y0 + top), int(right - left), int(bottom - top)],
+        "rle": encode_rle(mask[top:bottom, left:right]),
+    }
+
+
+def get_instances_path(label_path: Path) -> Path:
+    return label_path.with_suffix(".json")
+
+
+def save_instances(path: Path, height: int, width: int, instances: list[dict]):
+    # replaced atomically: the GUI may read it while a worker thread writes it
+    tmp_path = path.with_name(f".{path.stem}.{threading.get_ident()}.tmp.json")
+    with open(tmp_path, "w") as f:
+        json.dump({"height": height, "width": width, "instances": instances}, f)
+    os.replace(tmp_path, path)
+
+
+def load_instances(path: Path) -> list[dict]:
+    with open(path, "r") as f:
+        return json.load(f)["instances"]
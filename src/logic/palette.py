@@ -0,0 +1,58 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+
+def load_id2color(class_path: Path) -> dict[int, str]:
+    with open(class_path, "r") as f:
+        classes = json.load(f)["classes"]
+    return {c["id"]: c["color"] for c in classes}
+
+
+def hex_to_bgra(color: str) -> tuple[int, int, int, int]:
+    color = color.lstrip("#")
+    r, g, b = (int(color[i : i + 2], 16) for i in (0, 2, 4))
+    return b, g, r, 255
+
+
+def pack_bgra(image: np.ndarray) -> np.ndarray:
+    # (h, w, 4) uint8 in BGRA order -> (h, w) uint32, one key per pixel
+    return np.ascontiguousarray(image).view(np.uint32)[:, :, 0]
+
+
+def palette_keys(id2color: dict[int, str]) -> tuple[np.ndarray, np.ndarray]:
+    # sorted packed colors and the class ids they map to
+    ids = np.array(list(id2color.keys()), dtype=np.uint8)
+    keys = pack_bgra(
+        np.array([[hex_to_bgra(c) for c in id2color.values()]], dtype=np.uint8)
+    )[0]
+    order = np.argsort(keys)
+    return keys[order], ids[order]
+
+
+def to_bgra(label: np.ndarray) -> np.ndarray:
+    # labels are written by Qt as RGBA, but be lenient with what cv2 returns
+    if label.ndim == 2:
+        label = np.dstack([label] * 3)
+    if label.shape[2] == 3:
+        # without alpha, pure black is the (transparent) background
+        alpha = np.where(label.any(axis=2, keepdims=True), 255, 0).astype(np.uint8)
+        label = np.concatenate([label, alpha], axis=2)
+    return label
+
+
+def colors_to_ids(label: np.ndarray, id2color: dict[int, str]) -> np.ndarray:
+    # unknown colors and transparent pixels become 0 (background)
+    keys, ids = palette_keys(id2color)
+    packed = pack_bgra(to_bgra(label))
+    pos = np.searchsorted(keys, packed).clip(max=len(keys) - 1)
+    return np.where(keys[pos] == packed, ids[pos], 0).astype(np.uint8)
+
+
+def ids_to_colors(class_ids: np.ndarray, id2color: dict[int, str]) -> np.ndarray:
+    # class id map -> BGRA image as LabelLayer saves it (background transparent)
+    lut = np.zeros((256, 4), dtype=np.uint8)
+    for class_id, color in id2color.items():
+        lut[class_id] = hex_to_bgra(color)
+    return lut[class_ids]
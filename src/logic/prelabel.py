@@ -0,0 +1,110 @@
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import cv2
+from dotenv import load_dotenv
+
+from .palette import ids_to_colors, load_id2color
+from .segmentation import SegmentationModel
+
+_model = None  # one model per worker process
+
+
+def _init_worker(model_path: str, server_address: str | None, server_authkey: bytes):
+    global _model
+    _model = SegmentationModel(model_path, server_address, server_authkey)
+
+
+def _prelabel(args) -> str | None:
+    image_path, label_path, roi_path, roi_padding, id2color = args
+    image = cv2.imread(str(image_path))
+    if image is None:
+        print("skip (unreadable):", image_path.name)
+        return None
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    roi_mask = SegmentationModel.load_roi_mask(roi_path) if roi_path.exists() else None
+    labeled_image, _ = _model.predict_in_roi(image, roi_mask, roi_padding)
+
+    # 書き込み途中のファイルが残らないように一時ファイル経由で置き換える
+    tmp_path = label_path.with_name(f".{label_path.stem}.tmp.png")
+    cv2.imwrite(str(tmp_path), ids_to_colors(labeled_image, id2color))
+    os.replace(tmp_path, label_path)
+    return image_path.name
+
+
+def prelabel_workset(
+    workdir: Path,
+    class_path: Path,
+    model_path: str,
+    roi_padding: int = 0,
+    workers: int = 1,
+    server_address: str | None = None,
+    server_authkey: bytes = b"",
+):
+    image_dir = workdir / "images"
+    label_dir = workdir / "labels"
+    roi_dir = workdir / "roi"
+    label_dir.mkdir(exist_ok=True)
+    id2color = load_id2color(class_path)
+
+    # 既にラベルがある画像は飛ばすので、中断しても再実行で続きから処理できる
+    tasks = [
+        (
+            image_path,
+            label_dir / f"{image_path.stem}.png",
+            roi_dir / f"{image_path.stem}.png",
+            roi_padding,
+            id2color,
+        )
+        for image_path in sorted(image_dir.iterdir())
+        if not (label_dir / f"{image_path.stem}.png").exists()
+    ]
+    print(f"{len(tasks)} images without labels")
+    if not tasks:
+        return
+
+    start = time.perf_counter()
+    done = 0
+    # spawn: CUDA cannot be used from forked workers
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(model_path, server_address, server_authkey),
+    ) as executor:
+        futures = [executor.submit(_prelabel, task) for task in tasks]
+        for future in as_completed(futures):
+            if future.result() is None:
+                continue
+            done += 1
+            if done % 50 == 0:
+                elapsed = time.perf_counter() - start
+                print(f"{done}/{len(tasks)} labeled, {done / elapsed:.2f} img/s")
+
+    elapsed = time.perf_counter() - start
+    print(f"{done} labels written in {elapsed:.1f}s ({done / elapsed:.2f} img/s)")
+
+
+if __name__ == "__main__":
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(
+        description="Write initial labels/*.png from model predictions"
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    top_work_dir = Path(os.environ["TOP_WORK_DIR"]).expanduser()
+    prelabel_workset(
+        top_work_dir / os.environ["WORKSET"],
+        top_work_dir / "classes.json",
+        os.environ["SEGMENTATION_MODEL"],
+        roi_padding=int(os.environ.get("ROI_PADDING", "0")),
+        workers=args.workers,
+        server_address=os.environ.get("INFERENCE_SERVER"),
+        server_authkey=os.environ.get("INFERENCE_AUTHKEY", "").encode(),
+    )
@@ -0,0 +1,151 @@
+import os
+import socket
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from .palette import pack_bgra, to_bgra
+
+# image height, image width, tile x, tile y, tile w, tile h, payload length
+_HEADER = struct.Struct("<IIIIIII")
+LOCK_FILE = "session.lock"
+
+
+class SessionInUseError(RuntimeError):
+    """The workset is open in another running app."""
+
+
+def _is_running(pid: int, host: str) -> bool:
+    if host != socket.gethostname():
+        return True  # cannot tell, e.g. a workset on a network share
+    if os.name == "nt":
+        return False  # os.kill would terminate it
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # running as another user
+    return True
+
+
+class RecoveryJournal:
+    """Crash-recovery journal of unsaved label tiles.
+
+    The GUI thread only copies dirty tiles; compressing and appending them
+    to `<stem>.recovery` runs on a single background thread, which also
+    keeps appends and discards in submission order. `session.lock` holds
+    the PID of the running app: finding it at startup with that process gone
+    means the previous session ended abnormally and the journals have to be
+    replayed; with the process alive, the workset is in use and must not be
+    touched.
+    """
+
+    def __init__(self, recovery_dir: Path):
+        self.recovery_dir = recovery_dir
+        self.recovery_dir.mkdir(exist_ok=True)
+        self.lock_path = self.recovery_dir / LOCK_FILE
+        self.owner = self._read_owner()  # (pid, host) of a live session or None
+        self.crashed = self.lock_path.exists() and self.owner is None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def _read_owner(self) -> tuple[int, str] | None:
+        try:
+            pid, host = self.lock_path.read_text().split(maxsplit=1)
+            owner = int(pid), host.strip()
+        # no lock, or an empty one from an older version / torn write
+        except (FileNotFoundError, ValueError):
+            return None
+        return owner if _is_running(*owner) else None
+
+    def _path(self, stem: str) -> Path:
+        return self.recovery_dir / f"{stem}.recovery"
+
+    def start_session(self):
+        # call before touching any journal of the workset
+        if self.owner is None:
+            self.lock_path.unlink(missing_ok=True)  # stale
+            try:
+                fd = os.open(self.lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            except FileExistsError:  # another app started just now
+                self.owner = self._read_owner() or (0, "?")
+            else:
+                with os.fdopen(fd, "w") as f:
+                    f.write(f"{os.getpid()} {socket.gethostname()}")
+        if self.owner is not None:
+            pid, host = self.owner
+            raise SessionInUseError(
+                f"The workset is already open (pid {pid} on {host}).\n"
+                f"If that app is not running, delete {self.lock_path}"
+            )
+
+    def end_session(self):
+        self._executor.shutdown(wait=True)
+        self.lock_path.unlink(missing_ok=True)
+
+    def append(
+        self,
+        stem: str,
+        shape: tuple[int, int],
+        tiles: list[tuple[int, int, np.ndarray]],
+    ):
+        self._executor.submit(self._write, self._path(stem), shape, tiles)
+
+    def discard(self, stem: str):
+        self._executor.submit(self._path(stem).unlink, missing_ok=True)
+
+    @staticmethod
+    def _write(path: Path, shape: tuple[int, int], tiles):
+        with open(path, "ab") as f:
+            for x, y, tile in tiles:
+                payload = zlib.compress(tile.tobytes(), 1)
+                th, tw = tile.shape
+                f.write(_HEADER.pack(*shape, x, y, tw, th, len(payload)))
+                f.write(payload)
+
+    def replay_all(self, label_dir: Path) -> list[str]:
+        recovered = []
+        for path in sorted(self.recovery_dir.glob("*.recovery")):
+            label_path = label_dir / f"{path.stem}.png"
+            if self._replay(path, label_path):
+                recovered.append(path.stem)
+            path.unlink()
+        return recovered
+
+    @staticmethod
+    def _replay(path: Path, label_path: Path) -> bool:
+        with open(path, "rb") as f:
+            data = f.read()
+
+        packed = None
+        offset = 0
+        while offset + _HEADER.size <= len(data):
+            h, w, x, y, tw, th, length = _HEADER.unpack_from(data, offset)
+            offset += _HEADER.size
+            if offset + length > len(data):
+                break  # torn write at the end
+            tile = np.frombuffer(
+                zlib.decompress(data[offset : offset + length]), np.uint32
+            )
+            offset += length
+
+            if packed is None:
+                label = (
+                    cv2.imread(str(label_path), cv2.IMREAD_UNCHANGED)
+                    if label_path.exists()
+                    else None
+                )
+                if label is None or label.shape[:2] != (h, w):
+                    label = np.zeros((h, w, 4), dtype=np.uint8)
+                packed = pack_bgra(to_bgra(label)).copy()
+            packed[y : y + th, x : x + tw] = tile.reshape((th, tw))
+
+        if packed is None:
+            return False
+        label = packed.view(np.uint8).reshape(packed.shape + (4,))
+        cv2.imwrite(str(label_path), label)
+        return True
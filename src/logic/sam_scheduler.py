@@ -0,0 +1,106 @@
+import heapq
+import itertools
+import logging
+import threading
+from collections.abc import Callable
+from pathlib import Path
+
+import numpy as np
+
+from .segmentation import INFERENCE_ERRORS
+
+logger = logging.getLogger(__name__)
+
+# lower runs first
+CURRENT = 0
+NEARBY = 1
+IDLE = 2
+
+
+class SamScheduler(threading.Thread):
+    """Runs SAM for queued images in the background, most urgent first.
+
+    Resubmitting an image only ever raises its priority; the heap keeps the
+    stale entry, which is skipped when popped. Images whose sam/*.png is
+    newer than the image are not run again.
+    """
+
+    def __init__(
+        self,
+        model,
+        sam_dir: Path,
+        roi_dir: Path,
+        roi_padding: int = 0,
+        on_done: Callable[[Path, np.ndarray, list[dict]], None] | None = None,
+    ):
+        super().__init__(daemon=True)
+        self._model = model
+        self._sam_dir = sam_dir
+        self._roi_dir = roi_dir
+        self._roi_padding = roi_padding
+        self.on_done = on_done  # (image_path, labeled, instances), worker thread
+
+        self._condition = threading.Condition()
+        self._heap = []
+        self._pending = {}  # image path -> queued priority
+        self._counter = itertools.count()  # FIFO within a priority
+        self._stopped = False
+
+    def sam_path(self, image_path: Path) -> Path:
+        return self._sam_dir / (image_path.stem + ".png")
+
+    def is_done(self, image_path: Path) -> bool:
+        sam_path = self.sam_path(image_path)
+        try:
+            return sam_path.stat().st_mtime >= image_path.stat().st_mtime
+        except FileNotFoundError:
+            return False
+
+    def submit(self, image_path: Path, priority: int = IDLE):
+        with self._condition:
+            if self._pending.get(image_path, priority + 1) <= priority:
+                return
+            self._pending[image_path] = priority
+            heapq.heappush(self._heap, (priority, next(self._counter), image_path))
+            self._condition.notify()
+
+    def submit_many(self, image_paths: list[Path], priority: int = IDLE):
+        for image_path in image_paths:
+            self.submit(image_path, priority)
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def _pop(self) -> Path | None:
+        with self._condition:
+            while True:
+                while not self._heap and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return None
+                priority, _, image_path = heapq.heappop(self._heap)
+                if self._pending.get(image_path) == priority:
+                    del self._pending[image_path]
+                    return image_path
+
+    def run(self):
+        while (image_path := self._pop()) is not None:
+            if not image_path.exists() or self.is_done(image_path):
+                continue
+            try:
+                labeled_image, instances = self._model.segment(
+                    image_path,
+                    roi_path=self._roi_dir / (image_path.stem + ".png"),
+                    roi_padding=self._roi_padding,
+                )
+                self._model.save_segmentation(
+                    self.sam_path(image_path), labeled_image, instances
+                )
+            except INFERENCE_ERRORS as e:  # unreadable or half-copied image
+                logger.warning("auto SAM failed for %s: %s", image_path.name, e)
+                continue
+            logger.info("auto SAM: %s", image_path.name)
+            if self.on_done is not None:
+                self.on_done(image_path, labeled_image, instances)
@@ -1,4 +1,6 @@
+import logging
 import os
+import threading
 from pathlib import Path
 
 import cv2
@@ -6,20 +8,41 @@ import numpy as np
 from dotenv import load_dotenv
 from ultralytics import YOLO
 
+from .inference_client import InferenceClient, RawPrediction
+from .instances import encode_instance, get_instances_path, save_instances
+
+logger = logging.getLogger(__name__)
+
+# what decoding an input, running the model or the inference server raise for
+# one request; anything else is a bug and is not swallowed by the workers
+INFERENCE_ERRORS = (cv2.error, OSError, ValueError, EOFError, RuntimeError)
+
 
 class SegmentationModel:
-    def __init__(self, model_path: Path):
+    def __init__(
+        self,
+        model_path: Path,
+        server_address: str | None = None,
+        server_authkey: bytes = b"",
+    ):
         self.model_path = model_path
         self.model = None
         self.number_of_parts = 10  # depends on the model
+        self._lock = threading.Lock()
+        # 推論サーバーが指定されていればモデルを読み込まずにサーバーへ送る
+        self._client = (
+            InferenceClient(server_address, server_authkey) if server_address else None
+        )
 
     def _prepare_model(self):
-        if self.model is None:
-            self.model = YOLO(self.model_path)
+        with self._lock:
+            if self.model is None:
+                self.model = YOLO(self.model_path)
 
     @staticmethod
-    def _undone_yolo_letterbox(mask, target_height: int, target_width: int):
-        mask_np = mask.data.cpu().numpy().squeeze()
+    def _undone_yolo_letterbox(
+        mask_np: np.ndarray, target_height: int, target_width: int
+    ):
         mask_height, mask_width = mask_np.shape
 
         # スケール計算 (アスペクト比を維持しつつ最大化)
@@ -48,36 +71,167 @@ class SegmentationModel:
 
         return mask_cropped.astype(bool)
 
-    def predict(self, image: np.ndarray) -> np.ndarray:
+    @staticmethod
+    def _raw_from_result(result) -> RawPrediction:
+        if not result.boxes or not result.masks:
+            return (
+                np.zeros(0, dtype=np.int64),
+                np.zeros(0, dtype=np.float32),
+                np.zeros((0, 1, 1), dtype=np.float32),
+            )
+        return (
+            result.boxes.cls.cpu().numpy().astype(np.int64),
+            result.boxes.conf.cpu().numpy().astype(np.float32),
+            result.masks.data.cpu().numpy().astype(np.float32),
+        )
+
+    def infer_raw(self, images: list[np.ndarray]) -> list[RawPrediction]:
+        if self._client is not None:
+            return self._client.infer(images)
         self._prepare_model()
-        results = self.model(image)
+        # the model is shared between the GUI and background workers
+        with self._lock:
+            results = self.model(images)
+        return [self._raw_from_result(result) for result in results]
+
+    def _masks_from_raw(
+        self, raw: RawPrediction, h: int, w: int
+    ) -> list[tuple[int, float, np.ndarray]]:
+        return [
+            (int(cls), float(conf), self._undone_yolo_letterbox(mask, h, w))
+            for cls, conf, mask in zip(*raw)
+        ]
 
-        h, w = image.shape[:2]
-        parts = {i: np.zeros((h, w), dtype=bool) for i in range(self.number_of_parts)}
-
-        for result in results:
-            if not result.boxes or not result.masks:
-                continue
-            for box, mask in zip(result.boxes, result.masks):
-                part_id = int(box.cls)
-                parts[part_id] = np.bitwise_or(
-                    parts[part_id],
-                    self._undone_yolo_letterbox(mask, h, w),
-                )
+    def predict_masks_batch(
+        self, images: list[np.ndarray]
+    ) -> list[list[tuple[int, float, np.ndarray]]]:
+        return [
+            self._masks_from_raw(raw, *image.shape[:2])
+            for raw, image in zip(self.infer_raw(images), images)
+        ]
 
-        labeled_image = np.zeros((h, w), dtype=np.uint8)
-        for part_id, mask in parts.items():
-            if np.any(mask):
-                labeled_image[mask] = part_id + 1
+    def _predict_masks(self, image: np.ndarray) -> list[tuple[int, float, np.ndarray]]:
+        return self.predict_masks_batch([image])[0]
 
+    @staticmethod
+    def _merge_masks(
+        masks: list[tuple[int, float, np.ndarray]], h: int, w: int
+    ) -> np.ndarray:
+        # 同じクラスのインスタンスは一つの値にまとめる (クラスIDが大きい方が優先)
+        labeled_image = np.zeros((h, w), dtype=np.uint8)
+        for part_id, _, mask in sorted(masks, key=lambda m: m[0]):
+            labeled_image[mask] = part_id + 1
         return labeled_image
 
-    def segment_image(self, input_path: Path, output_path: Path):
+    def predict(self, image: np.ndarray) -> np.ndarray:
+        h, w = image.shape[:2]
+        return self._merge_masks(self._predict_masks(image), h, w)
+
+    def predict_instances(self, image: np.ndarray) -> tuple[np.ndarray, list[dict]]:
+        return self.predict_in_roi(image, None)
+
+    @staticmethod
+    def load_roi_mask(roi_path: Path) -> np.ndarray | None:
+        roi = cv2.imread(str(roi_path), cv2.IMREAD_UNCHANGED)
+        if roi is None:
+            return None
+        if roi.ndim == 2:
+            return roi > 0
+        if roi.shape[2] == 4:
+            return (roi[:, :, 3] > 0) & roi[:, :, :3].any(axis=2)
+        return roi.any(axis=2)
+
+    @staticmethod
+    def roi_bbox(
+        roi_mask: np.ndarray, padding: int = 0
+    ) -> tuple[int, int, int, int] | None:
+        # (x0, y0, x1, y1), exclusive on the right/bottom
+        rows = np.flatnonzero(roi_mask.any(axis=1))
+        if rows.size == 0:
+            return None
+        y0, y1 = rows[0], rows[-1] + 1
+        cols = np.flatnonzero(roi_mask[y0:y1].any(axis=0))
+        x0, x1 = cols[0], cols[-1] + 1
+
+        h, w = roi_mask.shape
+        return (
+            max(0, int(x0) - padding),
+            max(0, int(y0) - padding),
+            min(w, int(x1) + padding),
+            min(h, int(y1) + padding),
+        )
+
+    def predict_in_roi(
+        self, image: np.ndarray, roi_mask: np.ndarray | None, padding: int = 0
+    ) -> tuple[np.ndarray, list[dict]]:
+        h, w = image.shape[:2]
+        if roi_mask is not None and roi_mask.shape != (h, w):
+            logger.warning("ROI size does not match the image, running on full frame")
+            roi_mask = None
+
+        labeled_image = np.zeros((h, w), dtype=np.uint8)
+        if roi_mask is None:
+            bbox = (0, 0, w, h)
+        else:
+            bbox = self.roi_bbox(roi_mask, padding)
+            if bbox is None:
+                return labeled_image, []
+
+        # 推論はROIの外接矩形だけで行い、結果を元の座標に貼り戻す
+        x0, y0, x1, y1 = bbox
+        masks = self._predict_masks(np.ascontiguousarray(image[y0:y1, x0:x1]))
+        if roi_mask is not None:
+            roi_crop = roi_mask[y0:y1, x0:x1]
+            masks = [(part_id, score, m & roi_crop) for part_id, score, m in masks]
+
+        labeled_image[y0:y1, x0:x1] = self._merge_masks(masks, y1 - y0, x1 - x0)
+        instances = [
+            encode_instance(part_id + 1, score, m, x0, y0)
+            for part_id, score, m in masks
+        ]
+        return labeled_image, [i for i in instances if i is not None]
+
+    def segment(
+        self,
+        input_path: Path,
+        roi_path: Path | None = None,
+        roi_padding: int = 0,
+    ) -> tuple[np.ndarray, list[dict]]:
         image = cv2.imread(str(input_path))
         image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        labeled_image = self.predict(image)
-        cv2.imwrite(output_path, labeled_image)
+        roi_mask = (
+            self.load_roi_mask(roi_path)
+            if roi_path is not None and roi_path.exists()
+            else None
+        )
+        return self.predict_in_roi(image, roi_mask, roi_padding)
+
+    @staticmethod
+    def save_segmentation(
+        output_path: Path, labeled_image: np.ndarray, instances: list[dict]
+    ):
+        # json first: a PNG without its sidecar falls back to color picking
+        output_path = Path(output_path)
+        save_instances(get_instances_path(output_path), *labeled_image.shape, instances)
+        # 書き込み途中のPNGを読み込まないように一時ファイル経由で置き換える
+        # (GUIとバックグラウンドSAMが同時に書くことがあるのでスレッドごとに分ける)
+        tmp_path = output_path.with_name(
+            f".{output_path.stem}.{threading.get_ident()}.tmp.png"
+        )
+        cv2.imwrite(str(tmp_path), labeled_image)
+        os.replace(tmp_path, output_path)
+
+    def segment_image(
+        self,
+        input_path: Path,
+        output_path: Path,
+        roi_path: Path | None = None,
+        roi_padding: int = 0,
+    ) -> tuple[np.ndarray, list[dict]]:
+        labeled_image, instances = self.segment(input_path, roi_path, roi_padding)
+        self.save_segmentation(output_path, labeled_image, instances)
         # cv2.imwrite(output_path, (labeled_image+ 1) * 10)
+        return labeled_image, instances
 
 
 if __name__ == "__main__":
@@ -88,4 +242,3 @@ if __name__ == "__main__":
     model.segment_image(
         input_path, input_path.parent.parent / "sam" / (input_path.stem + ".png")
     )
-
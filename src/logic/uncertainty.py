@@ -0,0 +1,153 @@
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from .segmentation import INFERENCE_ERRORS
+
+logger = logging.getLogger(__name__)
+
+
+def uncertainty_score(masks: list[tuple[int, float, np.ndarray]]) -> float:
+    # 1.0 = the model has no idea, 0.0 = confident and consistent
+    if not masks:
+        return 1.0
+
+    # area-weighted lack of confidence over all instances
+    areas = np.array([m.sum() for _, _, m in masks], dtype=np.float64)
+    confs = np.array([score for _, score, _ in masks])
+    low_conf = float(np.average(1.0 - confs, weights=areas)) if areas.sum() else 1.0
+
+    # share of the covered pixels that are claimed by more than one class
+    per_class = {}
+    for part_id, _, mask in masks:
+        per_class[part_id] = per_class.get(part_id, False) | mask
+    claims = np.sum(list(per_class.values()), axis=0, dtype=np.uint8)
+    covered = np.count_nonzero(claims)
+    disagreement = np.count_nonzero(claims > 1) / covered if covered else 0.0
+
+    return 0.5 * low_conf + 0.5 * disagreement
+
+
+class UncertaintyIndex:
+    """Persistent {image name: score} cache, invalidated by image mtime."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        if path.exists():
+            with open(path, "r") as f:
+                self._entries = json.load(f)
+
+    def get(self, image_path: Path, mtime: float | None = None) -> float | None:
+        # mtime: already known by the caller, saves a stat per image
+        with self._lock:
+            entry = self._entries.get(image_path.name)
+        if entry is None:
+            return None
+        if mtime is None:
+            try:
+                mtime = image_path.stat().st_mtime
+            except OSError:
+                return None  # deleted, the workset is not refreshed yet
+        return entry["score"] if entry["mtime"] == mtime else None
+
+    def set(self, image_path: Path, score: float):
+        try:
+            mtime = image_path.stat().st_mtime
+        except OSError:
+            return
+        with self._lock:
+            self._entries[image_path.name] = {"mtime": mtime, "score": score}
+
+    def save(self):
+        with self._lock:
+            data = json.dumps(self._entries)
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(data)
+        os.replace(tmp_path, self.path)
+
+
+class UncertaintyScorer(threading.Thread):
+    """Scores unlabeled, unscored images in batches in the background.
+
+    Once everything is scored it sleeps until `wake` is called for new
+    images. Images that fail to score are logged and skipped until restart.
+    """
+
+    def __init__(
+        self,
+        model,
+        index: UncertaintyIndex,
+        candidates: callable,
+        batch_size: int = 8,
+    ):
+        super().__init__(daemon=True)
+        self._model = model
+        self._index = index
+        self._candidates = candidates  # () -> list of image paths to consider
+        self._batch_size = batch_size
+        self._stop_event = threading.Event()
+        self._wake_event = threading.Event()
+        self._failed = set()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake_event.set()
+
+    def wake(self):
+        self._wake_event.set()
+
+    def _next_batch(self) -> list[Path]:
+        batch = []
+        for image_path in self._candidates():
+            if image_path in self._failed:
+                continue
+            if self._index.get(image_path) is None:
+                batch.append(image_path)
+                if len(batch) >= self._batch_size:
+                    break
+        return batch
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self._wake_event.clear()
+            batch = self._next_batch()
+            if not batch:
+                self._wake_event.wait()  # new images or stop
+                continue
+
+            readable, images = [], []
+            for image_path in batch:
+                image = cv2.imread(str(image_path))
+                if image is None:
+                    self._index.set(image_path, 0.0)  # never rank broken files
+                    continue
+                readable.append(image_path)
+                images.append(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+            if images:
+                try:
+                    results = self._model.predict_masks_batch(images)
+                except INFERENCE_ERRORS as e:
+                    logger.warning("batch failed, scoring one by one: %s", e)
+                    results = [
+                        self._predict_one(p, i) for p, i in zip(readable, images)
+                    ]
+                for image_path, masks in zip(readable, results):
+                    if masks is not None:
+                        self._index.set(image_path, uncertainty_score(masks))
+            self._index.save()
+            logger.info("scored %d images", len(batch))
+
+    def _predict_one(self, image_path: Path, image: np.ndarray) -> list | None:
+        try:
+            return self._model.predict_masks_batch([image])[0]
+        except INFERENCE_ERRORS as e:
+            logger.warning("failed to score %s: %s", image_path.name, e)
+            self._failed.add(image_path)
+            return None
@@ -0,0 +1,187 @@
+import logging
+import os
+import struct
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# kind, x, y, w, h, payload length
+_HEADER = struct.Struct("<cIIIII")
+_STROKE = b"S"
+_UNDO = b"U"
+_REDO = b"R"
+
+
+class UndoJournal:
+    """Append-only, per-image journal of label stroke deltas.
+
+    Every stroke appends the changed rectangle before and after the stroke
+    (zlib compressed) to `<stem>.journal`. Undo/redo append small marker
+    records, so the stack of an image is rebuilt by replaying its file the
+    first time it is needed. Journals of least recently used images are
+    deleted once the directory grows beyond `max_bytes`.
+    """
+
+    def __init__(self, journal_dir: Path, max_bytes: int):
+        self.journal_dir = journal_dir
+        self.max_bytes = max_bytes
+        self.journal_dir.mkdir(exist_ok=True)
+        self._sizes = {
+            p.stem: p.stat().st_size for p in self.journal_dir.glob("*.journal")
+        }
+
+        self._stem = None
+        self._baseline = None  # label state (uint32 words) after the last record
+        self._stack = None  # [(offset, x, y, w, h, length)], loaded lazily
+        self._cursor = 0  # number of strokes currently applied
+
+    @property
+    def nbytes(self) -> int:
+        return self._baseline.nbytes if self._baseline is not None else 0
+
+    def _path(self, stem: str) -> Path:
+        return self.journal_dir / f"{stem}.journal"
+
+    def open(self, stem: str, packed: np.ndarray):
+        self._stem = stem
+        self._baseline = packed.copy()
+        self._stack = None
+        path = self._path(stem)
+        if path.exists():
+            os.utime(path)  # mark as recently used
+
+    def _append(self, kind: bytes, x=0, y=0, w=0, h=0, payload=b"") -> int:
+        path = self._path(self._stem)
+        with open(path, "ab") as f:
+            offset = f.tell()
+            f.write(_HEADER.pack(kind, x, y, w, h, len(payload)))
+            f.write(payload)
+        self._sizes[self._stem] = self._sizes.get(self._stem, 0) + (
+            _HEADER.size + len(payload)
+        )
+        return offset
+
+    def record(self, packed: np.ndarray, rect: tuple[int, int, int, int] | None):
+        # rect: (x0, y0, x1, y1) that may have changed since the last record
+        if self._stem is None or packed.shape != self._baseline.shape:
+            return
+        h, w = packed.shape
+        x0, y0, x1, y1 = rect if rect is not None else (0, 0, w, h)
+        x0, y0, x1, y1 = max(0, x0), max(0, y0), min(w, x1), min(h, y1)
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        changed = packed[y0:y1, x0:x1] != self._baseline[y0:y1, x0:x1]
+        rows = np.flatnonzero(changed.any(axis=1))
+        if rows.size == 0:
+            return
+        cols = np.flatnonzero(changed[rows[0] : rows[-1] + 1].any(axis=0))
+        x, y = x0 + int(cols[0]), y0 + int(rows[0])
+        pw, ph = int(cols[-1] - cols[0]) + 1, int(rows[-1] - rows[0]) + 1
+
+        before = self._baseline[y : y + ph, x : x + pw]
+        after = packed[y : y + ph, x : x + pw]
+        payload = zlib.compress(before.tobytes() + after.tobytes(), 1)
+        offset = self._append(_STROKE, x, y, pw, ph, payload)
+        self._baseline[y : y + ph, x : x + pw] = after
+
+        if self._stack is not None:
+            del self._stack[self._cursor :]
+            self._stack.append((offset, x, y, pw, ph, len(payload)))
+            self._cursor += 1
+        self._evict()
+
+    def _load_stack(self):
+        if self._stack is not None:
+            return
+        stack, cursor = [], 0
+        path = self._path(self._stem)
+        if path.exists():
+            with open(path, "rb") as f:
+                data = f.read()
+            offset = 0
+            while offset + _HEADER.size <= len(data):
+                kind, x, y, w, h, length = _HEADER.unpack_from(data, offset)
+                if offset + _HEADER.size + length > len(data):
+                    break
+                if kind == _STROKE:
+                    del stack[cursor:]
+                    stack.append((offset, x, y, w, h, length))
+                    cursor += 1
+                elif kind == _UNDO:
+                    cursor = max(0, cursor - 1)
+                elif kind == _REDO:
+                    cursor = min(len(stack), cursor + 1)
+                offset += _HEADER.size + length
+            if offset < len(data):
+                # drop a torn record at the end so that appends stay parseable
+                os.truncate(path, offset)
+                self._sizes[self._stem] = offset
+        self._stack, self._cursor = stack, cursor
+
+    def _read_patches(self, entry) -> tuple[np.ndarray, np.ndarray]:
+        offset, _, _, w, h, length = entry
+        with open(self._path(self._stem), "rb") as f:
+            f.seek(offset + _HEADER.size)
+            data = zlib.decompress(f.read(length))
+        patches = np.frombuffer(data, dtype=np.uint32).reshape((2, h, w))
+        return patches[0], patches[1]
+
+    def undo(self) -> tuple[int, int, np.ndarray] | None:
+        if self._stem is None:
+            return None
+        self._load_stack()
+        if self._cursor == 0:
+            return None
+        entry = self._stack[self._cursor - 1]
+        if not self._fits(entry):
+            return None
+        before, _ = self._read_patches(entry)
+        self._cursor -= 1
+        self._append(_UNDO)
+        return self._apply(entry, before)
+
+    def redo(self) -> tuple[int, int, np.ndarray] | None:
+        if self._stem is None:
+            return None
+        self._load_stack()
+        if self._cursor >= len(self._stack):
+            return None
+        entry = self._stack[self._cursor]
+        if not self._fits(entry):
+            return None
+        _, after = self._read_patches(entry)
+        self._cursor += 1
+        self._append(_REDO)
+        return self._apply(entry, after)
+
+    def _fits(self, entry) -> bool:
+        # a journal written for another image of the same stem is ignored
+        _, x, y, w, h, _ = entry
+        height, width = self._baseline.shape
+        if x + w <= width and y + h <= height:
+            return True
+        logger.warning("undo history does not match the label size, ignored")
+        return False
+
+    def _apply(self, entry, patch: np.ndarray) -> tuple[int, int, np.ndarray]:
+        _, x, y, w, h, _ = entry
+        self._baseline[y : y + h, x : x + w] = patch
+        return x, y, patch
+
+    def _evict(self):
+        total = sum(self._sizes.values())
+        if total <= self.max_bytes:
+            return
+        paths = sorted(
+            (self._path(stem) for stem in self._sizes if stem != self._stem),
+            key=lambda p: p.stat().st_mtime if p.exists() else 0,
+        )
+        for path in paths:
+            if total <= self.max_bytes:
+                break
+            total -= self._sizes.pop(path.stem, 0)
+            path.unlink(missing_ok=True)
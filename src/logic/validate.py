@@ -0,0 +1,199 @@
+import argparse
+import json
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+from dotenv import load_dotenv
+from PIL import Image
+
+from .palette import hex_to_bgra, load_id2color, pack_bgra, palette_keys, to_bgra
+
+NUMBER_OF_PARTS = 10  # same as SegmentationModel.number_of_parts
+
+
+def image_size(path: Path) -> tuple[int, int] | None:
+    # (h, w) from the file header, without decoding the pixels
+    try:
+        with Image.open(path) as image:
+            w, h = image.size
+    except (OSError, SyntaxError):  # not an image / corrupt header
+        return None
+    return h, w
+
+
+def snap_to_palette(label: np.ndarray, id2color: dict[int, str]) -> np.ndarray:
+    # alpha < 128 -> transparent, otherwise the nearest class color (RGB distance)
+    label = to_bgra(label)
+    packed = pack_bgra(label)
+    colors, inverse = np.unique(packed, return_inverse=True)
+    bgra = colors.view(np.uint8).reshape(-1, 4).astype(np.int32)
+
+    palette = np.array([hex_to_bgra(c) for c in id2color.values()], dtype=np.int32)
+    dist = ((bgra[:, None, :3] - palette[None, :, :3]) ** 2).sum(axis=2)
+    snapped = palette[dist.argmin(axis=1)].astype(np.uint8)
+    snapped[bgra[:, 3] < 128] = 0
+
+    snapped_packed = pack_bgra(snapped[None])[0]
+    fixed = snapped_packed[inverse.reshape(packed.shape)]
+    return fixed.view(np.uint8).reshape(packed.shape + (4,))
+
+
+def _check_label(label: np.ndarray, keys: np.ndarray) -> list[dict]:
+    issues = []
+    if label.ndim != 3 or label.shape[2] != 4:
+        issues.append({"type": "no_alpha"})
+    label = to_bgra(label)
+    alpha = label[:, :, 3]
+
+    antialiased = int(np.count_nonzero((alpha > 0) & (alpha < 255)))
+    if antialiased:
+        issues.append({"type": "antialiased", "pixels": antialiased})
+
+    opaque = pack_bgra(label)[alpha == 255]
+    unknown = opaque[~np.isin(opaque, keys)]
+    if unknown.size:
+        colors = Counter(unknown.tolist()).most_common(5)
+        issues.append(
+            {
+                "type": "unknown_colors",
+                "pixels": int(unknown.size),
+                "top": [
+                    {"color": f"#{c & 0xFFFFFF:06X}", "pixels": n} for c, n in colors
+                ],
+            }
+        )
+    return issues
+
+
+def _validate_sample(args) -> dict:
+    stem, image_path, label_path, sam_path, roi_path, id2color, fix = args
+    keys, _ = palette_keys(id2color)
+    issues = []
+
+    size = image_size(image_path) if image_path else None
+    if image_path is None:
+        issues.append({"file": "images", "type": "missing"})
+    elif size is None:
+        issues.append({"file": "images", "type": "unreadable"})
+
+    if label_path.exists():
+        label = cv2.imread(str(label_path), cv2.IMREAD_UNCHANGED)
+        if label is None:
+            issues.append({"file": "labels", "type": "unreadable"})
+        else:
+            if size is not None and label.shape[:2] != size:
+                issues.append(
+                    {"file": "labels", "type": "size", "size": list(label.shape[:2])}
+                )
+            label_issues = _check_label(label, keys)
+            issues += [{"file": "labels", **issue} for issue in label_issues]
+            if fix and label_issues:
+                tmp_path = label_path.with_name(f".{label_path.stem}.tmp.png")
+                cv2.imwrite(str(tmp_path), snap_to_palette(label, id2color))
+                os.replace(tmp_path, label_path)
+                issues.append({"file": "labels", "type": "fixed"})
+
+    if sam_path.exists():
+        sam = cv2.imread(str(sam_path), cv2.IMREAD_UNCHANGED)
+        if sam is None:
+            issues.append({"file": "sam", "type": "unreadable"})
+        else:
+            if size is not None and sam.shape[:2] != size:
+                issues.append(
+                    {"file": "sam", "type": "size", "size": list(sam.shape[:2])}
+                )
+            if sam.ndim == 3:
+                sam = sam[:, :, 0]
+            if sam.max() > NUMBER_OF_PARTS:
+                issues.append(
+                    {"file": "sam", "type": "class_id", "max": int(sam.max())}
+                )
+
+    if roi_path.exists():
+        roi_size = image_size(roi_path)
+        if roi_size is None:
+            issues.append({"file": "roi", "type": "unreadable"})
+        elif size is not None and roi_size != size:
+            issues.append({"file": "roi", "type": "size", "size": list(roi_size)})
+
+    return {"sample": stem, "issues": issues}
+
+
+def validate_workset(
+    workdir: Path,
+    class_path: Path,
+    report_path: Path,
+    fix: bool = False,
+    workers: int | None = None,
+) -> Counter:
+    id2color = load_id2color(class_path)
+    image_dir = workdir / "images"
+    label_dir, sam_dir, roi_dir = workdir / "labels", workdir / "sam", workdir / "roi"
+
+    images = {p.stem: p for p in image_dir.iterdir()}
+    stems = set(images)
+    for d in (label_dir, sam_dir, roi_dir):
+        if d.exists():
+            stems.update(p.stem for p in d.glob("*.png"))  # orphans too
+
+    tasks = [
+        (
+            stem,
+            images.get(stem),
+            label_dir / f"{stem}.png",
+            sam_dir / f"{stem}.png",
+            roi_dir / f"{stem}.png",
+            id2color,
+            fix,
+        )
+        for stem in sorted(stems)
+    ]
+
+    start = time.perf_counter()
+    summary = Counter()
+    with (
+        ProcessPoolExecutor(max_workers=workers) as executor,
+        open(report_path, "w") as report,
+    ):
+        for result in executor.map(_validate_sample, tasks, chunksize=64):
+            if not result["issues"]:
+                continue
+            report.write(json.dumps(result) + "\n")
+            summary.update(
+                f"{issue['file']}:{issue['type']}" for issue in result["issues"]
+            )
+
+    elapsed = time.perf_counter() - start
+    print(f"checked {len(tasks)} samples in {elapsed:.1f}s")
+    for key, count in sorted(summary.items()):
+        print(f"  {key}: {count}")
+    return summary
+
+
+if __name__ == "__main__":
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(
+        description="Check labels/, sam/ and roi/ against the images and classes"
+    )
+    parser.add_argument("--report", type=Path, default=None)
+    parser.add_argument(
+        "--fix", action="store_true", help="snap label colors to the class palette"
+    )
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    top_work_dir = Path(os.environ["TOP_WORK_DIR"]).expanduser()
+    workdir = top_work_dir / os.environ["WORKSET"]
+    validate_workset(
+        workdir,
+        top_work_dir / "classes.json",
+        args.report or workdir / "validation_report.jsonl",
+        fix=args.fix,
+        workers=args.workers,
+    )
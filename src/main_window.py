@@ -1,6 +1,10 @@
+import logging
+import os
+import time
+from functools import partial
 from pathlib import Path
 
-from PyQt5.QtCore import Qt, pyqtSignal, pyqtSlot
+from PyQt5.QtCore import QFileSystemWatcher, Qt, QTimer, pyqtSignal, pyqtSlot
 from PyQt5.QtGui import QCloseEvent, QColor, QIcon, QKeyEvent, QKeySequence, QPixmap
 from PyQt5.QtWidgets import (
     QCheckBox,
@@ -20,11 +24,15 @@ from PyQt5.QtWidgets import (
 
 from .data_store import DataStore
 from .ui.graphics_view import GraphicsView
+from .ui.session_recorder import SessionRecorder
+
+logger = logging.getLogger(__name__)
 
 
 class MainWindow(QMainWindow):
     brush_feedback = pyqtSignal(int)  # allows QSlider react on mouse wheel
     sam_signal = pyqtSignal(bool)  # used to propagate sam mode to all widgets
+    sam_ready = pyqtSignal(object, object, object)  # background SAM results
 
     def __init__(self, data_store: DataStore):
         super(MainWindow, self).__init__()
@@ -84,6 +92,9 @@ class MainWindow(QMainWindow):
         self.ls_roi_slider.setSliderPosition(default_roi_opacity)
         self.ls_roi_slider.valueChanged.connect(self.on_ls_roi_slider_change)
 
+        self.ls_memory_value = QLabel()
+        self.ls_memory_value.setText("Memory: 0 MB")
+
         ls_vlay = QVBoxLayout(ls_group)
         ls_vlay.addWidget(self.ls_label_value)
         ls_vlay.addWidget(self.ls_label_slider)
@@ -91,6 +102,7 @@ class MainWindow(QMainWindow):
         ls_vlay.addWidget(self.ls_roi_slider)
         ls_vlay.addWidget(self.ls_sam_value)
         ls_vlay.addWidget(self.ls_sam_slider)
+        ls_vlay.addWidget(self.ls_memory_value)
 
         # SAM group
         sam_group = QGroupBox(self.tr("SAM"))
@@ -117,9 +129,25 @@ class MainWindow(QMainWindow):
         self.bs_slider.setSliderPosition(default_bs_size)
         self.bs_slider.valueChanged.connect(self.on_bs_slider_change)
 
+        self.fill_checkbox = QCheckBox("Fill tool")
+        self.fill_checkbox.stateChanged.connect(self.on_fill_change)
+
+        default_fill_tolerance = 0
+        self.fill_tolerance_value = QLabel()
+        self.fill_tolerance_value.setText(f"Fill tolerance: {default_fill_tolerance}")
+        self.fill_tolerance_slider = QSlider()
+        self.fill_tolerance_slider.setOrientation(Qt.Orientation.Horizontal)
+        self.fill_tolerance_slider.setMinimum(0)
+        self.fill_tolerance_slider.setMaximum(100)
+        self.fill_tolerance_slider.setSliderPosition(default_fill_tolerance)
+        self.fill_tolerance_slider.valueChanged.connect(self.on_fill_tolerance_change)
+
         bs_vlay = QVBoxLayout(bs_group)
         bs_vlay.addWidget(self.bs_value)
         bs_vlay.addWidget(self.bs_slider)
+        bs_vlay.addWidget(self.fill_checkbox)
+        bs_vlay.addWidget(self.fill_tolerance_value)
+        bs_vlay.addWidget(self.fill_tolerance_slider)
 
         # Classs selection group
         cs_group = QGroupBox(self.tr("Classes"))
@@ -173,6 +201,11 @@ class MainWindow(QMainWindow):
         # ツールバーの作成
         toolbar = self.addToolBar("Tools")
 
+        # 不確かさ順の並びを最新のスコアで並べ直す
+        if self._data_store.annotation_order == "uncertainty":
+            rerank_action = toolbar.addAction("Re-rank")
+            rerank_action.triggered.connect(self._data_store.rerank_images)
+
         # 拡大ボタン
         zoom_in_action = toolbar.addAction("Zoom In")
         zoom_in_action.triggered.connect(lambda: self._graphics_view.scale(1.25, 1.25))
@@ -188,10 +221,62 @@ class MainWindow(QMainWindow):
         self._eraser_shortcut = QShortcut(QKeySequence("E"), self)
         self._eraser_shortcut.activated.connect(self._activate_eraser_mode)
 
+        # Fキーで塗りつぶしツール切替
+        self._fill_shortcut = QShortcut(QKeySequence("F"), self)
+        self._fill_shortcut.activated.connect(self.fill_checkbox.toggle)
+
         self._graphics_view.set_brush_color(QColor(self._id2color[1]))
         self.cs_list.setCurrentRow(0)
 
-        self._reset_undo_history()
+        # 0 (既定) なら全レイヤーを常に保持する
+        memory_budget_mb = int(os.environ.get("MEMORY_BUDGET_MB", "0"))
+        self._graphics_view.set_memory_budget(memory_budget_mb * 1024 * 1024)
+
+        # 未保存のラベルを定期的にリカバリ用ジャーナルへ書き出す
+        self._autosave_timer = QTimer(self)
+        self._autosave_timer.timeout.connect(self.autosave_label)
+        self._autosave_timer.timeout.connect(self._update_memory_usage)
+        self._autosave_timer.start(int(os.environ.get("AUTOSAVE_SECONDS", "5")) * 1000)
+
+        # images/ の追加・置き換えを監視し、まとめて反映する
+        self._image_watcher = QFileSystemWatcher(
+            [str(self._data_store.image_dir)], self
+        )
+        self._image_refresh_timer = QTimer(self)
+        self._image_refresh_timer.setSingleShot(True)
+        self._image_refresh_timer.setInterval(1000)
+        self._image_refresh_timer.timeout.connect(self.refresh_images)
+        self._image_watcher.directoryChanged.connect(
+            lambda _: self._image_refresh_timer.start()
+        )
+        if self._data_store.has_settling_images:
+            self._image_refresh_timer.start()
+
+        # RECORD_SESSION=1 で操作ログを残す (src.session_replay で再生できる)
+        self._recorder = None
+        if os.environ.get("RECORD_SESSION", "0") == "1":
+            session_dir = self._data_store.workdir / "sessions"
+            session_dir.mkdir(exist_ok=True)
+            self._recorder = SessionRecorder(
+                session_dir / time.strftime("%Y%m%d-%H%M%S.rec"),
+                self,
+                self._graphics_view,
+            )
+            for shortcut in (
+                self._sam_shortcut,
+                self._eraser_shortcut,
+                self._fill_shortcut,
+            ):
+                shortcut.activated.connect(
+                    partial(self._recorder.record_shortcut, shortcut.key()[0])
+                )
+            # clicked は手操作のときだけ発火する (ショートカット経由は上で記録)
+            self.sam_checkbox.clicked.connect(self._recorder.record_sam_mode)
+            self.fill_checkbox.clicked.connect(self._recorder.record_fill_mode)
+
+        self.sam_ready.connect(self._on_sam_ready)
+        if self._data_store.sam_scheduler is not None:
+            self._data_store.sam_scheduler.on_done = self.sam_ready.emit
 
     @pyqtSlot(int)
     def on_sam_change(self, state: int):
@@ -202,6 +287,15 @@ class MainWindow(QMainWindow):
         else:
             print("unsupported check state")
 
+    @pyqtSlot(int)
+    def on_fill_change(self, state: int):
+        self._graphics_view.set_fill_mode(state == Qt.CheckState.Checked)
+
+    @pyqtSlot(int)
+    def on_fill_tolerance_change(self, value: int):
+        self.fill_tolerance_value.setText(f"Fill tolerance: {value}")
+        self._graphics_view.set_fill_tolerance(value)
+
     @pyqtSlot(int)
     def on_ls_label_slider_change(self, value: int):
         self.ls_label_value.setText(f"Label opacity: {value}%")
@@ -211,11 +305,23 @@ class MainWindow(QMainWindow):
     def on_ls_sam_slider_change(self, value: int):
         self.ls_sam_value.setText(f"SAM opacity: {value}%")
         self._graphics_view.set_sam_opacity(value)
+        self._update_memory_usage()
 
     @pyqtSlot(int)
     def on_ls_roi_slider_change(self, value: int):
         self.ls_roi_value.setText(f"ROI opacity: {value}%")
         self._graphics_view.set_roi_opacity(value)
+        self._update_memory_usage()
+
+    def _update_memory_usage(self, log: bool = False):
+        usage = self._graphics_view.memory_usage()
+        usage["undo"] = self._data_store.undo_journal.nbytes
+        mb = {name: size / 1024 / 1024 for name, size in usage.items()}
+        breakdown = ", ".join(f"{name} {size:.0f} MB" for name, size in mb.items())
+        self.ls_memory_value.setText(f"Memory: {sum(mb.values()):.0f} MB")
+        self.ls_memory_value.setToolTip(breakdown)
+        if log:
+            logger.info("memory: %s", breakdown)
 
     @pyqtSlot(int)
     def on_bs_slider_change(self, value: int):
@@ -235,49 +341,126 @@ class MainWindow(QMainWindow):
 
     def save_current_label(self):
         self._graphics_view.save_label_to(self._data_store.get_current_label_path())
+        self._graphics_view.take_label_dirty_tiles()
+        self._data_store.mark_label_saved()
+
+    def autosave_label(self):
+        buffer = self._graphics_view.label_buffer()
+        if buffer is None or self._data_store.current_image_path is None:
+            return
+        tiles = self._graphics_view.take_label_dirty_tiles()
+        self._data_store.autosave_label(buffer.packed.shape, tiles)
 
     def accept_current_label(self):
+        duplicates = self._data_store.find_near_duplicates()
+        if duplicates:
+            names = "\n".join(
+                f"{path.name} (distance {distance})"
+                for path, distance in duplicates[:5]
+            )
+            reply = self._ask(
+                "Near-duplicate",
+                f"This image looks like {len(duplicates)} accepted image(s):\n"
+                f"{names}\n\nAccept anyway?",
+                QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
+                QMessageBox.StandardButton.No,
+            )
+            if reply != QMessageBox.StandardButton.Yes:
+                return
         self._data_store.transfer_image_to_accept(
             label_saver=self._graphics_view.save_label_to
         )
 
+    def _ask(
+        self,
+        title: str,
+        text: str,
+        buttons: QMessageBox.StandardButtons,
+        default: QMessageBox.StandardButton,
+    ) -> QMessageBox.StandardButton:
+        # the answer is recorded, so that a replay takes the same path
+        reply = QMessageBox.question(self, title, text, buttons, default)
+        if self._recorder is not None:
+            self._recorder.record_dialog(int(reply))
+        return reply
+
     def save_undo_state(self):
-        undo_file = self._data_store.save_undo_state()
-        self._graphics_view.save_label_to(undo_file)
+        buffer = self._graphics_view.label_buffer()
+        rect = self._graphics_view.take_label_dirty_rect()
+        if buffer is not None:
+            self._data_store.save_undo_state(buffer.packed, rect)
 
     def undo(self):
-        undo_file = self._data_store.undo()
-        if undo_file:
-            self._update_label(undo_file)
+        patch = self._data_store.undo()
+        if patch:
+            self._graphics_view.apply_label_patch(*patch)
 
     def redo(self):
-        redo_file = self._data_store.redo()
-        if redo_file:
-            self._update_label(redo_file)
+        patch = self._data_store.redo()
+        if patch:
+            self._graphics_view.apply_label_patch(*patch)
 
-    def _reset_undo_history(self):
-        self._data_store.reset_undo_history()
-        self.save_undo_state()
+    def _open_undo_history(self):
+        self._graphics_view.take_label_dirty_rect()
+        self._graphics_view.take_label_dirty_tiles()
+        buffer = self._graphics_view.label_buffer()
+        if buffer is not None:
+            self._data_store.open_undo_history(buffer.packed)
 
     def _load_sample(self, image_path: Path, fit: bool = True):
+        if self._data_store.check_image(image_path):
+            self._schedule_image_work([image_path], [])  # overwritten in place
         self._data_store.current_image_path = image_path
 
         label_path = self._data_store.get_current_label_path()
         sam_path = self._data_store.get_current_sam_path()
         roi_path = self._data_store.get_current_roi_path()
 
-        self._graphics_view.load_sample(
+        label_loaded = self._graphics_view.load_sample(
             image_path, label_path, sam_path, roi_path, fit=fit
         )
+        if not label_loaded:
+            QMessageBox.warning(
+                self,
+                "Unreadable label",
+                f"{label_path.name} could not be read and is shown blank.\n"
+                "It is not overwritten unless you draw on it.",
+            )
+        self._open_undo_history()
+        self._update_memory_usage(log=True)
+        self._data_store.schedule_sam_around(image_path)
+        if self._recorder is not None:
+            self._recorder.record_sample(image_path.name)
         name = image_path.stem
         self.ds_label.setText(f"{name[:30]}")
 
+    def _schedule_image_work(self, added: list[Path], removed: list[Path]):
+        self._data_store.schedule_sam(added)
+        self._data_store.schedule_uncertainty(added)
+        self._data_store.index_duplicates(added, removed)
+
+    def refresh_images(self):
+        added, removed = self._data_store.refresh_images()
+        if added or removed:
+            logger.info("images: %d added, %d removed", len(added), len(removed))
+        self._schedule_image_work(added, removed)
+        if self._data_store.has_settling_images:
+            self._image_refresh_timer.start()  # コピー中の画像を後で確認する
+
+    @pyqtSlot(object, object, object)
+    def _on_sam_ready(self, image_path: Path, labeled, instances):
+        if image_path != self._data_store.current_image_path:
+            return
+        self._graphics_view.update_sam_array(
+            labeled, instances, self._data_store.get_current_sam_path()
+        )
+
     def _update_label(self, label_path: Path):
         self._graphics_view.update_label(label_path)
 
     def load_latest_sample(self):
-        images = self._data_store.get_sorted_images()
-        self._load_sample(images[-1])  # 最新の画像を読み込む
+        # 最新の画像 (不確かさ順の場合は最も不確かな画像) を読み込む
+        self._load_sample(self._data_store.get_initial_image())
 
     def _switch_sample_by(self, step: int):
         """画像を切り替える処理"""
@@ -295,7 +478,6 @@ class MainWindow(QMainWindow):
 
         self.save_current_label()
         self._load_sample(new_image_path)
-        self._data_store.reset_undo_history()
 
     def _accept_annotation(self):
         self.accept_current_label()
@@ -304,8 +486,7 @@ class MainWindow(QMainWindow):
         if a0.key() == Qt.Key.Key_Space:
             self._graphics_view.reset_zoom()
         elif a0.key() == Qt.Key.Key_C:
-            reply = QMessageBox.question(
-                self,
+            reply = self._ask(
                 "Confirm",
                 "Are you sure you want to clear all?",
                 QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
@@ -313,6 +494,7 @@ class MainWindow(QMainWindow):
             )
             if reply == QMessageBox.StandardButton.Yes:
                 self._graphics_view.clear_label()
+                self.save_undo_state()
         elif a0.key() in range(49, 58):
             num_key = int(a0.key()) - 48
             color = self._id2color.get(num_key)
@@ -333,7 +515,11 @@ class MainWindow(QMainWindow):
         return super().keyPressEvent(a0)
 
     def closeEvent(self, a0: QCloseEvent) -> None:
+        self._autosave_timer.stop()
         self.save_current_label()
+        self._data_store.close()
+        if self._recorder is not None:
+            self._recorder.close()
         return super().closeEvent(a0)
 
     def _activate_eraser_mode(self):
@@ -343,9 +529,11 @@ class MainWindow(QMainWindow):
 
     def on_sam_run_clicked(self):
         print("SAM run button clicked")
+        if self._recorder is not None:
+            self._recorder.record_sam_run()
         try:
-            sam_path = self._data_store.run_sam()
-            self._graphics_view.update_sam(sam_path)
+            sam_path, labeled, instances, saving = self._data_store.run_sam()
+            self._graphics_view.update_sam_array(labeled, instances, sam_path, saving)
         except Exception:
             QMessageBox.warning(
                 self,
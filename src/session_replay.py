@@ -0,0 +1,241 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import deque
+from pathlib import Path
+
+import numpy as np
+from dotenv import load_dotenv
+from PyQt5.QtCore import QEvent, QPoint, QPointF, Qt
+from PyQt5.QtGui import QKeyEvent, QMouseEvent, QTransform, QWheelEvent
+from PyQt5.QtWidgets import QApplication, QMessageBox, QShortcut
+
+from .data_store import DataStore
+from .main_window import MainWindow
+from .ui.session_recorder import (
+    DIALOG,
+    EVENT_NAMES,
+    FILL_MODE,
+    KEY_PRESS,
+    MOUSE_MOVE,
+    MOUSE_PRESS,
+    MOUSE_RELEASE,
+    SAM_MODE,
+    SAM_RUN,
+    SAMPLE,
+    SHORTCUT,
+    VIEW,
+    WHEEL,
+    WINDOW,
+    read_session,
+)
+
+_MOUSE_EVENT_TYPES = {
+    MOUSE_PRESS: QEvent.Type.MouseButtonPress,
+    MOUSE_MOVE: QEvent.Type.MouseMove,
+    MOUSE_RELEASE: QEvent.Type.MouseButtonRelease,
+}
+_STATE_EVENTS = (VIEW, WINDOW, DIALOG)  # applied, but not timed
+
+
+def make_scratch_workdir(top_work_dir: Path, workset: str) -> Path:
+    # labels and sam (written by Run SAM) are copied so the replay never
+    # writes into the real workset; images and roi are only read and are linked
+    scratch = Path(tempfile.mkdtemp(prefix="image-sat-replay-"))
+    shutil.copy(top_work_dir / "classes.json", scratch / "classes.json")
+    workdir = scratch / workset
+    workdir.mkdir()
+    for name in ("images", "roi"):
+        if (top_work_dir / workset / name).exists():
+            (workdir / name).symlink_to((top_work_dir / workset / name).resolve())
+    for name in ("labels", "sam"):
+        if (top_work_dir / workset / name).exists():
+            shutil.copytree(top_work_dir / workset / name, workdir / name)
+    for name in ("images", "labels", "roi"):
+        (scratch / "replay_accepted" / name).mkdir(parents=True)
+    return scratch
+
+
+class SessionReplayer:
+    def __init__(self, main_window):
+        self.mw = main_window
+        self.view = main_window._graphics_view
+        self._buttons = Qt.MouseButton.NoButton
+        self._shortcuts = {
+            shortcut.key()[0]: shortcut
+            for shortcut in main_window.findChildren(QShortcut)
+        }
+        self._answers = deque()  # recorded dialog answers, in order
+
+    def answer(self, *args, **kwargs) -> QMessageBox.StandardButton:
+        # stands in for QMessageBox.question: the recorded answer, or the
+        # dialog's default button for recordings made without them
+        if self._answers:
+            return QMessageBox.StandardButton(self._answers.popleft())
+        default = args[4] if len(args) > 4 else kwargs.get("defaultButton")
+        if default in (None, QMessageBox.StandardButton.NoButton):
+            return QMessageBox.StandardButton.Yes  # Qt's pick for Yes | No
+        return default
+
+    def dispatch(self, kind: int, a: int, b: int, c: int, d: int, name: str | None):
+        if kind in _MOUSE_EVENT_TYPES:
+            if kind == MOUSE_MOVE:
+                button, self._buttons = Qt.MouseButton.NoButton, Qt.MouseButtons(c)
+            elif kind == MOUSE_PRESS:
+                button = Qt.MouseButton(c)
+                self._buttons = self._buttons | button
+            else:
+                button = Qt.MouseButton(c)
+                self._buttons = self._buttons & ~button
+            # the scene hit-tests with the screen position, so it has to match
+            viewport = self.view.viewport()
+            event = QMouseEvent(
+                _MOUSE_EVENT_TYPES[kind],
+                QPointF(a, b),
+                QPointF(viewport.mapTo(viewport.window(), QPoint(a, b))),
+                QPointF(viewport.mapToGlobal(QPoint(a, b))),
+                button,
+                self._buttons,
+                Qt.KeyboardModifiers(d),
+            )
+            QApplication.sendEvent(viewport, event)
+        elif kind == WHEEL:
+            event = QWheelEvent(
+                QPointF(a, b),
+                QPointF(self.view.viewport().mapToGlobal(QPoint(a, b))),
+                QPoint(),
+                QPoint(0, c),
+                self._buttons,
+                Qt.KeyboardModifiers(d),
+                Qt.ScrollPhase.NoScrollPhase,
+                False,
+            )
+            QApplication.sendEvent(self.view.viewport(), event)
+        elif kind == KEY_PRESS:
+            event = QKeyEvent(QEvent.Type.KeyPress, a, Qt.KeyboardModifiers(b))
+            QApplication.sendEvent(self.mw, event)
+        elif kind == SHORTCUT:
+            if a in self._shortcuts:
+                self._shortcuts[a].activated.emit()
+        elif kind == VIEW:
+            self.view.setTransform(QTransform.fromScale(a / 1e6, a / 1e6))
+            self.view.horizontalScrollBar().setValue(b)
+            self.view.verticalScrollBar().setValue(c)
+        elif kind == SAMPLE:
+            current = self.mw._data_store.current_image_path
+            if current is None or current.name != name:
+                if current is not None:
+                    self.mw.save_current_label()
+                self.mw._load_sample(self.mw._data_store.image_dir / name)
+        elif kind == SAM_MODE:
+            self.mw.sam_checkbox.setChecked(bool(a))
+        elif kind == FILL_MODE:
+            self.mw.fill_checkbox.setChecked(bool(a))
+        elif kind == WINDOW:
+            self.mw.resize(a, b)
+        elif kind == SAM_RUN:
+            self.mw.sam_run_button.click()
+        # DIALOG: answered by answer() while the event that asked is handled
+
+    def replay(self, events: list[tuple], realtime: bool = False) -> dict:
+        app = QApplication.instance()
+        self._answers = deque(event[2] for event in events if event[1] == DIALOG)
+        latencies = {}
+        start = time.perf_counter()
+        for t, kind, a, b, c, d, name in events:
+            if realtime:
+                while time.perf_counter() - start < t:
+                    app.processEvents()
+                    time.sleep(0.001)
+
+            # 入力の処理と、それによる再描画が終わるまでを1イベントの遅延とする
+            event_start = time.perf_counter()
+            self.dispatch(kind, a, b, c, d, name)
+            app.processEvents()
+            if kind not in _STATE_EVENTS:
+                latencies.setdefault(EVENT_NAMES[kind], []).append(
+                    time.perf_counter() - event_start
+                )
+        total = time.perf_counter() - start
+
+        report = {
+            "events": sum(len(v) for v in latencies.values()),
+            "recorded_seconds": events[-1][0] if events else 0.0,
+            "wall_seconds": total,
+            "latency_ms": {},
+        }
+        everything = [x for v in latencies.values() for x in v]
+        for key, values in sorted(latencies.items()) + [("all", everything)]:
+            if not values:
+                continue
+            ms = np.array(values) * 1000
+            report["latency_ms"][key] = {
+                "count": len(values),
+                "p50": float(np.percentile(ms, 50)),
+                "p95": float(np.percentile(ms, 95)),
+                "max": float(ms.max()),
+            }
+        return report
+
+
+def print_report(report: dict):
+    print(
+        f"replayed {report['events']} events in {report['wall_seconds']:.2f}s"
+        f" (recorded {report['recorded_seconds']:.2f}s)"
+    )
+    print(f"{'event':<16}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for key, stats in report["latency_ms"].items():
+        print(
+            f"{key:<16}{stats['count']:>8}{stats['p50']:>10.2f}"
+            f"{stats['p95']:>10.2f}{stats['max']:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(
+        description="Replay a recorded session headlessly and report latencies"
+    )
+    parser.add_argument("session", type=Path)
+    parser.add_argument(
+        "--realtime", action="store_true", help="keep the recorded pacing"
+    )
+    parser.add_argument("--report", type=Path, default=None, help="write JSON")
+    args = parser.parse_args()
+
+    events = read_session(args.session)
+
+    # 実際のワークセットには書き込まず、ダイアログは記録された回答で閉じる
+    top_work_dir = Path(os.environ["TOP_WORK_DIR"]).expanduser()
+    scratch = make_scratch_workdir(top_work_dir, os.environ["WORKSET"])
+    os.environ.update(
+        TOP_WORK_DIR=str(scratch),
+        ACCEPTED="replay_accepted",
+        RECORD_SESSION="0",
+        AUTO_SAM="0",
+        ANNOTATION_ORDER="mtime",  # no background scoring while timing
+        DUPLICATE_DISTANCE="0",  # nor hashing of the scratch copy
+    )
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    QMessageBox.warning = lambda *a, **k: QMessageBox.StandardButton.Ok
+
+    app = QApplication(sys.argv)
+    mw = MainWindow(DataStore())
+    replayer = SessionReplayer(mw)
+    QMessageBox.question = replayer.answer
+    mw.show()
+    if not any(event[1] == SAMPLE for event in events):
+        mw.load_latest_sample()
+
+    report = replayer.replay(events, realtime=args.realtime)
+    mw.close()
+    shutil.rmtree(scratch, ignore_errors=True)
+
+    print_report(report)
+    if args.report:
+        args.report.write_text(json.dumps(report, indent=2))
@@ -4,13 +4,14 @@ import numpy as np
 from PyQt5.QtCore import QPointF, pyqtSignal
 from PyQt5.QtGui import QColor
 from PyQt5.QtWidgets import (
-    QGraphicsPixmapItem,
     QGraphicsScene,
     QGraphicsSceneMouseEvent,
 )
 
 from .brush_cursor import BrushCursor
+from .image_item import ImageItem
 from .label_layer import LabelLayer
+from .overlay_layer import OverlayLayer
 from .roi_layer import RoiLayer
 from .sam_layer import SamLayer
 
@@ -25,15 +26,26 @@ class GraphicsScene(QGraphicsScene):
         self._brush_step = 5
         self._brush_limits = (1, 150)
 
-        self.image_item = QGraphicsPixmapItem()
-        self.sam_item = SamLayer(self.image_item, self.sam2label_signal)
-        self.roi_item = RoiLayer(self.image_item)
+        self.image_item = ImageItem()
+        # the layers only hold pixels, the overlay item draws them all at once
+        self.overlay_item = OverlayLayer(self.image_item)
+        self.sam_item = SamLayer(
+            self.image_item,
+            self.sam2label_signal,
+            on_changed=self.overlay_item.invalidate,
+        )
+        self.roi_item = RoiLayer(
+            self.image_item, on_changed=self.overlay_item.invalidate
+        )
         self.cursor_item = BrushCursor(self.image_item)
         self.label_item = LabelLayer(
             self.image_item,
             self.label2sam_signal,
             [self.cursor_item.set_size, parent.brush_size_changed],
+            roi_mask_getter=self.roi_item.mask,
+            on_changed=self.overlay_item.invalidate,
         )
+        self.overlay_item.set_layers([self.sam_item, self.roi_item, self.label_item])
 
         self.label2sam_signal.connect(self.sam_item.handle_click)
         self.sam2label_signal.connect(self.label_item.handle_bundle)
@@ -50,6 +62,12 @@ class GraphicsScene(QGraphicsScene):
         if value:
             self.cursor_item.set_border_color(QColor(255, 255, 255))
 
+    def set_fill_mode(self, value: bool):
+        self.label_item.set_fill_mode(value)
+
+    def set_fill_tolerance(self, value: int):
+        self.label_item.set_fill_tolerance(value)
+
     def set_brush_color(self, color: QColor):
         self.cursor_item.set_border_color(color)
         self.label_item.set_brush_color(color)
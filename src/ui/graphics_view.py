@@ -1,16 +1,22 @@
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 
+import numpy as np
 from PyQt5.QtCore import (
     QPoint,
     QPointF,
     QRectF,
+    QSize,
     QSizeF,
     Qt,
+    pyqtSignal,
     pyqtSlot,
 )
 from PyQt5.QtGui import (
     QBrush,
     QColor,
+    QImage,
+    QImageReader,
     QMouseEvent,
     QPainter,
     QPixmap,
@@ -22,6 +28,8 @@ from .graphics_scene import GraphicsScene
 
 
 class GraphicsView(QGraphicsView):
+    full_image_loaded = pyqtSignal(int, QImage)  # (load generation, image)
+
     def __init__(self, brush_feedback, parent=None, undo_callback=None):
         super().__init__(parent)
         self._scene = GraphicsScene(self)
@@ -30,6 +38,10 @@ class GraphicsView(QGraphicsView):
         self._last_pos = QPoint()
         self._brush_feedback = brush_feedback
         self._sam_mode = False
+        self._memory_budget = 0  # bytes, 0 = keep every layer fully resident
+        self._load_generation = 0  # drops decodes of samples that were left
+        self._decoder = ThreadPoolExecutor(max_workers=1)
+        self.full_image_loaded.connect(self._on_full_image_loaded)
 
         self.setScene(self._scene)
         self.setTransformationAnchor(QGraphicsView.ViewportAnchor.AnchorUnderMouse)
@@ -44,12 +56,63 @@ class GraphicsView(QGraphicsView):
 
     def set_label_opacity(self, value: int):
         self._scene.label_item.setOpacity(value / 100.0)
+        self._scene.overlay_item.invalidate()
 
     def set_sam_opacity(self, value: int):
         self._scene.sam_item.setOpacity(value / 100.0)
+        self._scene.overlay_item.invalidate()
+        self._apply_memory_budget()
 
     def set_roi_opacity(self, value: int):
         self._scene.roi_item.setOpacity(value / 100.0)
+        self._scene.overlay_item.invalidate()
+        self._apply_memory_budget()
+
+    def set_memory_budget(self, budget_bytes: int):
+        self._memory_budget = budget_bytes
+        self._apply_memory_budget()
+
+    def memory_usage(self) -> dict[str, int]:
+        pixmap = self._scene.image_item.pixmap()
+        return {
+            "image": pixmap.width() * pixmap.height() * pixmap.depth() // 8,
+            "label": self._scene.label_item.memory_bytes(),
+            "sam": self._scene.sam_item.memory_bytes(),
+            "roi": self._scene.roi_item.memory_bytes(),
+            "overlay": self._scene.overlay_item.memory_bytes(),
+        }
+
+    def _apply_memory_budget(self):
+        if not self._memory_budget:
+            return
+
+        # 非表示のレイヤーは保持しない (SAMのクリック判定はRLEで行える)
+        visible = []
+        for item in (self._scene.sam_item, self._scene.roi_item):
+            if item.opacity() == 0:
+                item.release_raster()
+            else:
+                visible.append(item)
+        self._scene.label_item.release_source_image()
+        if not visible:
+            return
+
+        # 表示中のレイヤーは予算に収まる解像度 (1, 1/2, 1/4, 1/8) で保持する
+        usage = self.memory_usage()
+        r = self._scene.image_item.full_rect()
+        # 合成済みタイルのキャッシュは画面2枚分までに抑える
+        viewport = self.viewport().size()
+        overlay = self._scene.overlay_item
+        overlay.max_bytes = viewport.width() * viewport.height() * 4 * 2
+        fixed = usage["image"] + usage["label"] + overlay.max_bytes
+        needed = r.width() * r.height() * 4 * len(visible)
+        available = max(0, self._memory_budget - fixed)
+        scale = 1.0
+        while scale > 0.125 and needed * scale * scale > available:
+            scale /= 2
+        for item in visible:
+            item.materialize_raster(scale)
+        self.viewport().update()
 
     @pyqtSlot(bool)
     def handle_sam_signal(self, is_sam: bool):
@@ -65,6 +128,12 @@ class GraphicsView(QGraphicsView):
     def set_eraser(self, value: bool):
         self._scene.set_eraser(value)
 
+    def set_fill_mode(self, value: bool):
+        self._scene.set_fill_mode(value)
+
+    def set_fill_tolerance(self, value: int):
+        self._scene.set_fill_tolerance(value)
+
     def reset_zoom(self):
         self.fitInView(self._scene.image_item, Qt.AspectRatioMode.KeepAspectRatio)
 
@@ -74,6 +143,19 @@ class GraphicsView(QGraphicsView):
     def save_label_to(self, path: Path):
         self._scene.save_label(path)
 
+    def label_buffer(self):
+        return self._scene.label_item.buffer
+
+    def take_label_dirty_rect(self) -> tuple[int, int, int, int] | None:
+        return self._scene.label_item.take_dirty_rect()
+
+    def take_label_dirty_tiles(self) -> list[tuple[int, int, np.ndarray]]:
+        return self._scene.label_item.take_dirty_tiles()
+
+    def apply_label_patch(self, x: int, y: int, patch: np.ndarray):
+        self._scene.label_item.apply_patch(x, y, patch)
+        self.viewport().update()
+
     def load_sample(
         self,
         image_path: Path,
@@ -81,37 +163,99 @@ class GraphicsView(QGraphicsView):
         sam_path: Path,
         roi_path: Path,
         fit: bool = True,
-    ):
-        image = QPixmap(str(image_path))
-        self._scene.setSceneRect(QRectF(QPointF(), QSizeF(image.size())))
-        self._scene.image_item.setPixmap(QPixmap(str(image_path)))
+    ) -> bool:
+        # False if the existing label could not be read (a blank one is shown)
+        full_size = self._load_image(image_path)
+        self._scene.setSceneRect(QRectF(QPointF(), QSizeF(full_size)))
 
-        self.update_label(label_path, trigger_update=False)
+        label_loaded = self.update_label(label_path, trigger_update=False)
 
         self.update_sam(sam_path, trigger_update=False)
         self.update_roi(roi_path, trigger_update=False)
+        self._apply_memory_budget()
         if fit:
             self.fitInView(self._scene.image_item, Qt.AspectRatioMode.KeepAspectRatio)
             self.centerOn(self._scene.image_item)
+        return label_loaded
+
+    def _load_image(self, image_path: Path) -> QSize:
+        self._load_generation += 1
+        reader = QImageReader(str(image_path))
+        full_size = reader.size()  # header only
+
+        # 画面より十分大きい画像は縮小デコードで先に表示し、原寸は別スレッドで読む
+        view_size = self.viewport().size().expandedTo(QSize(512, 512))
+        scale = min(
+            view_size.width() / max(1, full_size.width()),
+            view_size.height() / max(1, full_size.height()),
+        )
+        if not full_size.isValid() or scale >= 0.5:
+            image = reader.read()
+            self._scene.image_item.set_image(QPixmap.fromImage(image))
+            return image.size()
+
+        reader.setScaledSize(full_size * scale)
+        preview = reader.read()
+        self._scene.image_item.set_image(QPixmap.fromImage(preview), full_size)
+        self._decoder.submit(self._decode_full, self._load_generation, image_path)
+        return full_size
+
+    def _decode_full(self, generation: int, image_path: Path):
+        # worker thread: QImage (unlike QPixmap) may be created here
+        if generation != self._load_generation:
+            return
+        image = QImageReader(str(image_path)).read()
+        self.full_image_loaded.emit(generation, image)
+
+    @pyqtSlot(int, QImage)
+    def _on_full_image_loaded(self, generation: int, image: QImage):
+        if generation != self._load_generation or image.isNull():
+            return
+        self._scene.image_item.set_image(QPixmap.fromImage(image))
+        self._scene.update()
 
-    def update_label(self, label_path: Path, trigger_update: bool = True):
+    def update_label(self, label_path: Path, trigger_update: bool = True) -> bool:
+        # False if the label file exists but could not be read
+        loaded = True
         if label_path.exists():
-            self._scene.label_item.set_image(str(label_path))
+            loaded = self._scene.label_item.set_image(str(label_path))
         else:
             self._scene.label_item.clear()
         if trigger_update:
             self.viewport().update()
+        return loaded
 
     def update_sam(self, sam_path: Path, trigger_update: bool = True):
         if sam_path.exists():
-            self._scene.sam_item.set_image(str(sam_path))
+            self._scene.sam_item.set_image(
+                str(sam_path), lazy=bool(self._memory_budget)
+            )
+        else:
+            self._scene.sam_item.clear()
         if trigger_update:
+            self._apply_memory_budget()
             self.viewport().update()
 
+    def update_sam_array(
+        self,
+        labeled: np.ndarray,
+        instances: list[dict],
+        sam_path: Path,
+        saving: Future | None = None,
+    ):
+        self._scene.sam_item.set_array(labeled, instances, str(sam_path), saving)
+        self._apply_memory_budget()
+        self.viewport().update()
+
     def update_roi(self, roi_path: Path, trigger_update: bool = True):
         if roi_path.exists():
-            self._scene.roi_item.set_image(str(roi_path))
+            self._scene.roi_item.set_image(
+                str(roi_path), lazy=bool(self._memory_budget)
+            )
+        else:
+            self._scene.roi_item.clear()
         if trigger_update:
+            self._apply_memory_budget()
             self.viewport().update()
 
     def scrollBy(self, point: QPoint):
@@ -0,0 +1,168 @@
+from concurrent.futures import Future
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PyQt5 import sip
+from PyQt5.QtCore import QSize
+from PyQt5.QtGui import QImage, QImageReader
+
+
+def qimage_view(image: QImage, channels: int) -> np.ndarray:
+    # (h, w, channels) numpy view over the memory of `image`, rows may be padded
+    buffer = image.bits()
+    buffer.setsize(image.byteCount())
+    np_img = np.frombuffer(buffer, dtype=np.uint8)
+    np_img = np_img.reshape((image.height(), image.bytesPerLine()))
+    return np_img[:, : image.width() * channels].reshape(
+        (image.height(), image.width(), channels)
+    )
+
+
+class ImageBuffer:
+    """A numpy array and a QImage sharing the same pixels.
+
+    Pixels are premultiplied ARGB32, i.e. BGRA bytes / 0xAARRGGBB words, so
+    fully opaque or fully transparent pixels match QColor.rgba() directly.
+    The QImage does not own its memory: it is only valid while this object
+    keeps the array alive, so never hand out the QImage beyond a paint call.
+    """
+
+    FORMAT = QImage.Format.Format_ARGB32_Premultiplied
+
+    def __init__(self, array: np.ndarray):
+        assert array.ndim == 3 and array.shape[2] == 4 and array.dtype == np.uint8
+        self.array = np.ascontiguousarray(array)
+        h, w = self.array.shape[:2]
+        # voidptr over the raw address selects the writable QImage(uchar*, ...)
+        # overload, so painting writes into self.array instead of detaching
+        self.qimage = QImage(
+            sip.voidptr(self.array.ctypes.data), w, h, w * 4, self.FORMAT
+        )
+
+    @classmethod
+    def blank(cls, width: int, height: int) -> "ImageBuffer":
+        return cls(np.zeros((height, width, 4), dtype=np.uint8))
+
+    @classmethod
+    def from_qimage(cls, image: QImage) -> "ImageBuffer":
+        image = image.convertToFormat(cls.FORMAT)
+        return cls(qimage_view(image, 4).copy())
+
+    @classmethod
+    def load(cls, path: str) -> "ImageBuffer | None":
+        image = QImage(path)
+        if image.isNull():
+            return None
+        return cls.from_qimage(image)
+
+    @property
+    def packed(self) -> np.ndarray:
+        # (h, w) uint32 view, one 0xAARRGGBB word per pixel
+        return self.array.view(np.uint32)[:, :, 0]
+
+    @property
+    def width(self) -> int:
+        return self.array.shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.array.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        return self.array.nbytes
+
+    def save(self, path: Path) -> bool:
+        return self.qimage.save(str(path))
+
+
+class LazyImageBuffer:
+    """ImageBuffer backed by a file, so it can be dropped or kept downscaled.
+
+    `buffer` is what gets painted and may be None (released) or reduced by
+    `scale`; `full()` always returns full-resolution pixels, re-reading the
+    file for the duration of the call when only a reduced copy is resident.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.buffer = None
+        self.scale = 1.0
+        self._pinned = None  # full pixels kept until `_saving` has written path
+        self._saving = None
+
+    def load(self, path: str | None, lazy: bool = False):
+        self.path = path
+        self.buffer = ImageBuffer.load(path) if path and not lazy else None
+        self.scale = 1.0
+        self._pinned = self._saving = None
+
+    def set(
+        self,
+        buffer: ImageBuffer,
+        path: str | None = None,
+        saving: Future | None = None,
+    ):
+        # already decoded pixels; `path` is where they are (being) persisted.
+        # Until `saving` succeeds the file is stale or missing, so the pixels
+        # are kept and never re-read from it
+        self.path = path
+        self.buffer = buffer
+        self.scale = 1.0
+        self._pinned = buffer if saving is not None else None
+        self._saving = saving
+
+    def _file_ready(self) -> bool:
+        if self._saving is not None:
+            if not self._saving.done() or self._saving.exception() is not None:
+                return False
+            self._pinned = self._saving = None
+        return True
+
+    def release(self):
+        if self.path is not None and self._file_ready():
+            self.buffer = None
+
+    def materialize(self, scale: float = 1.0):
+        if self.path is None:
+            return
+        if self.buffer is not None and self.scale == scale:
+            return
+        if not self._file_ready():
+            if scale >= 1.0:
+                self.buffer = self._pinned
+            else:
+                pinned = self._pinned.array
+                size = (
+                    max(1, int(pinned.shape[1] * scale)),
+                    max(1, int(pinned.shape[0] * scale)),
+                )
+                self.buffer = ImageBuffer(
+                    cv2.resize(pinned, size, interpolation=cv2.INTER_AREA)
+                )
+        elif scale >= 1.0:
+            self.buffer = ImageBuffer.load(self.path)
+        else:
+            reader = QImageReader(self.path)
+            size = reader.size()
+            reader.setScaledSize(
+                QSize(
+                    max(1, int(size.width() * scale)),
+                    max(1, int(size.height() * scale)),
+                )
+            )
+            image = reader.read()
+            self.buffer = None if image.isNull() else ImageBuffer.from_qimage(image)
+        self.scale = min(scale, 1.0)
+
+    def full(self) -> ImageBuffer | None:
+        if self.buffer is not None and self.scale == 1.0:
+            return self.buffer
+        if not self._file_ready():
+            return self._pinned
+        return ImageBuffer.load(self.path) if self.path else None
+
+    @property
+    def nbytes(self) -> int:
+        return self.buffer.nbytes if self.buffer is not None else 0
@@ -0,0 +1,41 @@
+from PyQt5.QtCore import QRect, QRectF, QSize
+from PyQt5.QtGui import QPainter, QPixmap
+from PyQt5.QtWidgets import QGraphicsPixmapItem
+
+
+class ImageItem(QGraphicsPixmapItem):
+    """Image item that always spans the full image size.
+
+    A reduced preview can be shown while the full resolution is still being
+    decoded; it is stretched over the full rect, so child layers (which are
+    sized from `full_rect()`) stay aligned throughout.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._full_size = QSize()
+
+    def set_image(self, pixmap: QPixmap, full_size: QSize | None = None):
+        self._full_size = full_size if full_size is not None else pixmap.size()
+        self.prepareGeometryChange()
+        self.setPixmap(pixmap)
+
+    def is_preview(self) -> bool:
+        return self.pixmap().size() != self._full_size
+
+    def full_rect(self) -> QRect:
+        return QRect(0, 0, self._full_size.width(), self._full_size.height())
+
+    def boundingRect(self) -> QRectF:
+        return QRectF(self.full_rect())
+
+    def paint(self, painter, option, widget=None):
+        if not self.is_preview():
+            super().paint(painter, option, widget)
+            return
+        painter.save()
+        painter.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform)
+        painter.drawPixmap(
+            self.boundingRect(), self.pixmap(), QRectF(self.pixmap().rect())
+        )
+        painter.restore()
@@ -1,16 +1,35 @@
+from collections.abc import Callable
 from pathlib import Path
 
+import cv2
 import numpy as np
-from PyQt5.QtCore import QLineF, QPoint, QRectF, Qt
-from PyQt5.QtGui import QColor, QPainter, QPen, QPixmap
-from PyQt5.QtWidgets import QGraphicsRectItem, QGraphicsSceneMouseEvent
+from PyQt5.QtCore import QLineF, QPointF, QRectF, Qt
+from PyQt5.QtGui import QColor, QImage, QPainter, QPen
+from PyQt5.QtWidgets import (
+    QGraphicsItem,
+    QGraphicsRectItem,
+    QGraphicsSceneMouseEvent,
+)
+
+from .image_buffer import ImageBuffer, qimage_view
+
+TILE_SIZE = 256
 
 
 class LabelLayer(QGraphicsRectItem):
-    def __init__(self, parent, sam_signal, cursor_resizing_callbacks: list[callable]):
+    def __init__(
+        self,
+        parent,
+        sam_signal,
+        cursor_resizing_callbacks: list[callable],
+        roi_mask_getter: Callable[[], np.ndarray | None] | None = None,
+        on_changed: Callable[[tuple[int, int, int, int] | None], None] | None = None,
+    ):
         super().__init__(parent)
         self.setOpacity(0.35)
         self.setPen(QPen(Qt.PenStyle.NoPen))
+        # drawn by OverlayLayer, which is told about changes through on_changed
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemHasNoContents)
         self.setAcceptedMouseButtons(Qt.MouseButton.LeftButton)
 
         # Enable capturing mouse movement (without pressing) for Shift-resize
@@ -23,9 +42,17 @@ class LabelLayer(QGraphicsRectItem):
         self._erase_state = False
         self._brush_color = QColor(0, 0, 0)
         self._brush_size = 50
-        self._pixmap = QPixmap()
+        self._buffer = None  # ImageBuffer, painted and analysed in place
+        self._unreadable = False  # loaded label file was broken, left untouched
         self._line = QLineF()
         self._sam_mode = False
+        self._fill_mode = False
+        self._fill_tolerance = 0  # 0: fill same label color, >0: magic wand on image
+        self._roi_mask_getter = roi_mask_getter
+        self._on_changed = on_changed  # (x0, y0, x1, y1) or None for everything
+        self._image_cache = (None, None)  # (pixmap cacheKey, RGB np array)
+        self._dirty_rect = None  # (x0, y0, x1, y1) changed since last take
+        self._dirty_tiles = set()  # (tx, ty) changed since last take, for autosave
 
         self.cursor_resizing_callbacks = cursor_resizing_callbacks
 
@@ -39,6 +66,12 @@ class LabelLayer(QGraphicsRectItem):
     def set_size(self, size: int):
         self._brush_size = size
 
+    def set_fill_mode(self, value: bool):
+        self._fill_mode = value
+
+    def set_fill_tolerance(self, value: int):
+        self._fill_tolerance = value
+
     def _apply_resize_dx(self, dx: int):
         if dx == 0:
             return
@@ -65,8 +98,86 @@ class LabelLayer(QGraphicsRectItem):
         self._last_mouse_pos = None
         super().hoverMoveEvent(event)
 
+    @property
+    def buffer(self) -> ImageBuffer | None:
+        return self._buffer
+
+    def overlay_source(self) -> tuple[QImage | None, float]:
+        return (self._buffer.qimage if self._buffer is not None else None), 1.0
+
+    def _changed(self, rect: tuple[int, int, int, int] | None = None):
+        if self._on_changed is not None:
+            self._on_changed(rect)
+
+    def _mark_dirty(self, x0: int, y0: int, x1: int, y1: int):
+        self._unreadable = False  # edited: saving replaces the broken file
+        self._changed((x0, y0, x1, y1))
+        if self._buffer is not None:
+            tx0, ty0 = max(0, x0) // TILE_SIZE, max(0, y0) // TILE_SIZE
+            tx1 = (min(x1, self._buffer.width) - 1) // TILE_SIZE
+            ty1 = (min(y1, self._buffer.height) - 1) // TILE_SIZE
+            self._dirty_tiles.update(
+                (tx, ty) for tx in range(tx0, tx1 + 1) for ty in range(ty0, ty1 + 1)
+            )
+        if self._dirty_rect is not None:
+            dx0, dy0, dx1, dy1 = self._dirty_rect
+            x0, y0, x1, y1 = min(x0, dx0), min(y0, dy0), max(x1, dx1), max(y1, dy1)
+        self._dirty_rect = (x0, y0, x1, y1)
+
+    def _mark_all_dirty(self):
+        if self._buffer is not None:
+            self._mark_dirty(0, 0, self._buffer.width, self._buffer.height)
+
+    def memory_bytes(self) -> int:
+        _, source = self._image_cache
+        source_bytes = source.nbytes if source is not None else 0
+        buffer_bytes = self._buffer.nbytes if self._buffer is not None else 0
+        return buffer_bytes + source_bytes
+
+    def release_source_image(self):
+        self._image_cache = (None, None)
+
+    def take_dirty_rect(self) -> tuple[int, int, int, int] | None:
+        rect, self._dirty_rect = self._dirty_rect, None
+        return rect
+
+    def take_dirty_tiles(self) -> list[tuple[int, int, np.ndarray]]:
+        # copies, so that they can be handed over to another thread
+        tiles, self._dirty_tiles = self._dirty_tiles, set()
+        if self._buffer is None:
+            return []
+        packed = self._buffer.packed
+        return [
+            (
+                tx * TILE_SIZE,
+                ty * TILE_SIZE,
+                packed[
+                    ty * TILE_SIZE : (ty + 1) * TILE_SIZE,
+                    tx * TILE_SIZE : (tx + 1) * TILE_SIZE,
+                ].copy(),
+            )
+            for tx, ty in sorted(tiles)
+        ]
+
+    def apply_patch(self, x: int, y: int, patch: np.ndarray):
+        if self._buffer is None:
+            return
+        h, w = patch.shape
+        self._buffer.packed[y : y + h, x : x + w] = patch
+        self._mark_dirty(x, y, x + w, y + h)
+
     def _draw_line(self):
-        painter = QPainter(self._pixmap)
+        if self._buffer is None:
+            return
+        r = self._line.p1(), self._line.p2()
+        pad = self._brush_size // 2 + 2
+        self._mark_dirty(
+            int(min(r[0].x(), r[1].x())) - pad,
+            int(min(r[0].y(), r[1].y())) - pad,
+            int(max(r[0].x(), r[1].x())) + pad + 1,
+            int(max(r[0].y(), r[1].y())) + pad + 1,
+        )
+        painter = QPainter(self._buffer.qimage)
         if self._erase_state:
             painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_Clear)
         pen = QPen(self._brush_color, self._brush_size)
@@ -74,46 +185,99 @@ class LabelLayer(QGraphicsRectItem):
         painter.setPen(pen)
         painter.drawLine(self._line)
         painter.end()
-        self.update()
 
     def _draw_bundle(self, bundle: np.ndarray):
-        painter = QPainter(self._pixmap)
-        if self._erase_state:
-            painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_Clear)
-        pen = QPen(self._brush_color, 1)
-        painter.setPen(pen)
-        for x, y in bundle:
-            painter.drawPoint(x, y)
-        self._bundle_to_draw = None
-        painter.end()
-        self.update()
+        if self._buffer is None or len(bundle) == 0:
+            return
+        xs, ys = bundle[:, 0], bundle[:, 1]
+        inside = (xs < self._buffer.width) & (ys < self._buffer.height)
+        value = 0 if self._erase_state else self._brush_color.rgba()
+        self._buffer.packed[ys[inside], xs[inside]] = value
+        self._mark_dirty(
+            int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1
+        )
+
+    def _source_image(self) -> np.ndarray | None:
+        if self.parentItem().is_preview():
+            return None  # full resolution is still being decoded
+        pixmap = self.parentItem().pixmap()
+        key, np_img = self._image_cache
+        if key != pixmap.cacheKey():
+            image = pixmap.toImage().convertToFormat(QImage.Format.Format_RGB888)
+            np_img = qimage_view(image, 3).copy()
+            self._image_cache = (pixmap.cacheKey(), np_img)
+        return np_img
+
+    def _fill(self, pos: QPointF):
+        if self._buffer is None:
+            return
+        packed = self._buffer.packed
+        h, w = packed.shape
+        x, y = int(pos.x()), int(pos.y())
+        if not (0 <= x < w and 0 <= y < h):
+            return
 
-    def set_image(self, path: str):
-        r = self.parentItem().pixmap().rect()
+        # floodFill does not cross non-zero mask pixels, so pre-mark outside of ROI
+        mask = np.zeros((h + 2, w + 2), dtype=np.uint8)
+        roi = self._roi_mask_getter() if self._roi_mask_getter else None
+        if roi is not None and roi.shape == (h, w):
+            if not roi[y, x]:
+                return
+            np.logical_not(roi, out=mask[1:-1, 1:-1].view(bool))
+
+        flags = 4 | cv2.FLOODFILL_MASK_ONLY | (255 << 8)
+        if self._fill_tolerance > 0:
+            src = self._source_image()
+            if src is None or src.shape[:2] != (h, w):
+                return
+            diff = (self._fill_tolerance,) * 3
+            flags |= cv2.FLOODFILL_FIXED_RANGE
+        else:
+            src = (packed == packed[y, x]).view(np.uint8)
+            diff = (0,) * 3
+        _, _, _, (rx, ry, rw, rh) = cv2.floodFill(
+            src, mask, (x, y), 0, diff, diff, flags
+        )
+        # only the filled bounding rect (inside the ROI) is written and marked
+        filled = mask[1 + ry : 1 + ry + rh, 1 + rx : 1 + rx + rw] == 255
+
+        value = 0 if self._erase_state else self._brush_color.rgba()
+        np.copyto(packed[ry : ry + rh, rx : rx + rw], np.uint32(value), where=filled)
+        self._mark_dirty(rx, ry, rx + rw, ry + rh)
+
+    def set_image(self, path: str) -> bool:
+        # False if the file could not be read (e.g. truncated by a crash): the
+        # layer is blank and is not saved over the file until it is edited
+        r = self.parentItem().full_rect()
         self.setRect(QRectF(r))
-        self._pixmap.load(path)
+        buffer = ImageBuffer.load(path)
+        self._unreadable = buffer is None
+        self._buffer = buffer or ImageBuffer.blank(r.width(), r.height())
+        self._dirty_rect = None
+        self._dirty_tiles = set()
+        self._changed()
+        return not self._unreadable
 
     def clear(self):
-        r = self.parentItem().pixmap().rect()
+        r = self.parentItem().full_rect()
         self.setRect(QRectF(r))
-        self._pixmap = QPixmap(r.size())
-        self._pixmap.fill(Qt.GlobalColor.transparent)
-        self.update()  # to make changes be visible instantly
+        self._buffer = ImageBuffer.blank(r.width(), r.height())
+        self._mark_all_dirty()
 
     def export_pixmap(self, out_path: Path):
-        self._pixmap.save(str(out_path))
+        if self._buffer is not None and not self._unreadable:
+            self._buffer.save(out_path)
 
     def handle_bundle(self, bundle: np.ndarray):
         if self._sam_mode:
             self._draw_bundle(bundle)
 
-    def paint(self, painter, option, widget=None):
-        super().paint(painter, option, widget)
-        painter.save()
-        painter.drawPixmap(QPoint(), self._pixmap)
-        painter.restore()
-
     def mousePressEvent(self, event: QGraphicsSceneMouseEvent) -> None:
+        if self._fill_mode:
+            self._fill(event.pos())
+            super().mousePressEvent(event)
+            event.accept()
+            return
         self._sam_signal.emit(event.pos())
         self._line.setP1(event.pos())
         self._line.setP2(event.pos())
@@ -134,6 +298,8 @@ class LabelLayer(QGraphicsRectItem):
             return
         # Normal drawing path
         self._last_mouse_pos = None
+        if self._fill_mode:
+            return
 
         self._line.setP2(event.pos())
         self._draw_line()
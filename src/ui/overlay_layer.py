@@ -0,0 +1,109 @@
+from PyQt5.QtCore import QPoint, QRect, QRectF, Qt
+from PyQt5.QtGui import QImage, QPainter, QPen
+from PyQt5.QtWidgets import QGraphicsItem, QGraphicsRectItem
+
+from .label_layer import TILE_SIZE
+
+
+class OverlayLayer(QGraphicsRectItem):
+    """Draws the SAM, ROI and label layers as one cached composite.
+
+    The layers themselves have no contents for Qt to paint; they report
+    changes through `invalidate`. The blend of all layers with their
+    opacities is cached per TILE_SIZE tile, so a repaint is a single image
+    draw per exposed tile, and a stroke or an opacity change only
+    recomposites the tiles it affects. With `max_bytes` set, the least
+    recently painted tiles are dropped beyond that size.
+    """
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.setPen(QPen(Qt.PenStyle.NoPen))
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption)
+        self._layers = []  # bottom to top
+        self._tiles = {}  # (tx, ty) -> composited QImage, None if fully empty
+        self.max_bytes = 0  # 0: keep every tile
+
+    def set_layers(self, layers: list):
+        self._layers = layers
+
+    def invalidate(self, rect: tuple[int, int, int, int] | None = None):
+        # rect: (x0, y0, x1, y1) in image coordinates, None for everything
+        full = self.parentItem().full_rect()
+        if self.rect() != QRectF(full):
+            self.setRect(QRectF(full))
+            self._tiles.clear()
+        if rect is None:
+            self._tiles.clear()
+            self.update()
+            return
+
+        x0, y0, x1, y1 = rect
+        tx0, ty0 = max(0, x0) // TILE_SIZE, max(0, y0) // TILE_SIZE
+        tx1, ty1 = (max(0, x1) - 1) // TILE_SIZE, (max(0, y1) - 1) // TILE_SIZE
+        for tx in range(tx0, tx1 + 1):
+            for ty in range(ty0, ty1 + 1):
+                self._tiles.pop((tx, ty), None)
+        self.update(QRectF(x0, y0, x1 - x0, y1 - y0))
+
+    def memory_bytes(self) -> int:
+        return sum(tile.sizeInBytes() for tile in self._tiles.values() if tile)
+
+    def _composite(self, tile_rect: QRect) -> QImage | None:
+        sources = []
+        for layer in self._layers:
+            image, scale = layer.overlay_source()
+            if image is not None and layer.opacity() > 0 and layer.isVisible():
+                sources.append((image, scale, layer.opacity()))
+        if not sources:
+            return None
+
+        tile = QImage(tile_rect.size(), QImage.Format.Format_ARGB32_Premultiplied)
+        tile.fill(Qt.GlobalColor.transparent)
+        painter = QPainter(tile)
+        target = QRectF(0, 0, tile_rect.width(), tile_rect.height())
+        for image, scale, opacity in sources:
+            painter.setOpacity(opacity)
+            source = QRectF(tile_rect)
+            if scale != 1.0:  # reduced by the memory budget
+                source = QRectF(
+                    source.x() * scale,
+                    source.y() * scale,
+                    source.width() * scale,
+                    source.height() * scale,
+                )
+            painter.drawImage(target, image, source)
+        painter.end()
+        return tile
+
+    def paint(self, painter, option, widget=None):
+        full = self.parentItem().full_rect()
+        exposed = option.exposedRect.toAlignedRect().intersected(full)
+        if exposed.isEmpty():
+            return
+        txs = range(exposed.left() // TILE_SIZE, exposed.right() // TILE_SIZE + 1)
+        tys = range(exposed.top() // TILE_SIZE, exposed.bottom() // TILE_SIZE + 1)
+        for ty in tys:
+            for tx in txs:
+                if (tx, ty) in self._tiles:
+                    tile = self._tiles.pop((tx, ty))  # re-inserted as the newest
+                else:
+                    tile_rect = QRect(
+                        tx * TILE_SIZE, ty * TILE_SIZE, TILE_SIZE, TILE_SIZE
+                    ).intersected(full)
+                    tile = self._composite(tile_rect)
+                self._tiles[(tx, ty)] = tile
+                if tile is not None:
+                    painter.drawImage(QPoint(tx * TILE_SIZE, ty * TILE_SIZE), tile)
+        self._evict(len(self._tiles) - len(txs) * len(tys))
+
+    def _evict(self, evictable: int):
+        # oldest first; the tiles of the current paint are the newest
+        if not self.max_bytes:
+            return
+        size = self.memory_bytes()
+        for key in list(self._tiles)[:evictable]:
+            if size <= self.max_bytes:
+                break
+            tile = self._tiles.pop(key)
+            size -= tile.sizeInBytes() if tile else 0
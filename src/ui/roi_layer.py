@@ -1,42 +1,74 @@
-from PyQt5.QtCore import QPoint, QRectF, Qt
-from PyQt5.QtGui import QPen, QPixmap
-from PyQt5.QtWidgets import QGraphicsRectItem
+from collections.abc import Callable
+
+import numpy as np
+from PyQt5.QtCore import QRectF, Qt
+from PyQt5.QtGui import QImage, QPen
+from PyQt5.QtWidgets import QGraphicsItem, QGraphicsRectItem
+
+from .image_buffer import LazyImageBuffer
 
 
 class RoiLayer(QGraphicsRectItem):
-    def __init__(self, parent):
+    def __init__(
+        self,
+        parent,
+        on_changed: Callable[[tuple[int, int, int, int] | None], None] | None = None,
+    ):
         super().__init__(parent)
         self.setOpacity(0.2)
         self.setPen(QPen(Qt.PenStyle.NoPen))
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemHasNoContents)
+        self._on_changed = on_changed  # drawn by OverlayLayer
 
-        self._pixmap = QPixmap()
-        self._img = None  # QImage to fetch color from
-        self._np_img = None  # np array for fast pixels fetch
+        self._raster = LazyImageBuffer()  # for drawing and fast pixels fetch
+        self._mask = None  # bool ROI mask, built on first use
 
-    def set_image(self, path: str):
-        r = self.parentItem().pixmap().rect()
+    def set_image(self, path: str, lazy: bool = False):
+        r = self.parentItem().full_rect()
         self.setRect(QRectF(r))
-        self._pixmap.load(path)
-        self._update_img()
-
-    def _update_img(self):
-        image = self._pixmap.toImage()
-        buffer = image.bits()
-        buffer.setsize(image.byteCount())
-        # np_img = np.frombuffer(buffer, dtype=np.uint8)
-        # np_img = np_img.reshape((image.height(), image.width(), 4))
-        self._img = image
-        # self._np_img = np_img
+        self._raster.load(path, lazy=lazy)
+        self._mask = None
+        self._changed()
+
+    def mask(self) -> np.ndarray | None:
+        if self._raster.path is None:  # no ROI for this sample (cleared)
+            return None
+        if self._mask is None:
+            buffer = self._raster.full()
+            if buffer is None:
+                return None
+            # same rule as SegmentationModel.load_roi_mask (BGRA in memory)
+            np_img = buffer.array
+            self._mask = (np_img[:, :, 3] > 0) & np_img[:, :, :3].any(axis=2)
+        return self._mask
 
     def clear(self):
-        r = self.parentItem().pixmap().rect()
+        r = self.parentItem().full_rect()
         self.setRect(QRectF(r))
-        self._pixmap = QPixmap(r.size())
-        self._pixmap.fill(Qt.GlobalColor.transparent)
-        self.update()  # to make changes be visible instantly
-
-    def paint(self, painter, option, widget=None):
-        super().paint(painter, option, widget)
-        painter.save()
-        painter.drawPixmap(QPoint(), self._pixmap)
-        painter.restore()
+        self._raster.load(None)
+        self._mask = None
+        self._changed()
+
+    def overlay_source(self) -> tuple[QImage | None, float]:
+        buffer = self._raster.buffer
+        return (buffer.qimage if buffer is not None else None), self._raster.scale
+
+    def _changed(self):
+        if self._on_changed is not None:
+            self._on_changed(None)
+
+    def memory_bytes(self) -> int:
+        mask_bytes = self._mask.nbytes if self._mask is not None else 0
+        return self._raster.nbytes + mask_bytes
+
+    def release_raster(self):
+        buffer = self._raster.buffer
+        self._raster.release()
+        if self._raster.buffer is not buffer:
+            self._changed()
+
+    def materialize_raster(self, scale: float = 1.0):
+        buffer = self._raster.buffer
+        self._raster.materialize(scale)
+        if self._raster.buffer is not buffer:
+            self._changed()
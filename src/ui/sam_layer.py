@@ -1,59 +1,157 @@
+import logging
+from collections.abc import Callable
+from concurrent.futures import Future
+from pathlib import Path
+
 import numpy as np
-from PyQt5.QtCore import QPoint, QPointF, QRectF, Qt
-from PyQt5.QtGui import QPen, QPixmap
-from PyQt5.QtWidgets import QGraphicsRectItem
+from PyQt5.QtCore import QPointF, QRectF, Qt
+from PyQt5.QtGui import QImage, QPen
+from PyQt5.QtWidgets import QGraphicsItem, QGraphicsRectItem
+
+from ..logic.instances import (
+    decode_rle,
+    get_instances_path,
+    load_instances,
+    rle_contains,
+)
+from .image_buffer import ImageBuffer, LazyImageBuffer
+
+logger = logging.getLogger(__name__)
 
 
 class SamLayer(QGraphicsRectItem):
-    def __init__(self, parent, label_signal):
+    def __init__(
+        self,
+        parent,
+        label_signal,
+        on_changed: Callable[[tuple[int, int, int, int] | None], None] | None = None,
+    ):
         super().__init__(parent)
         self.setOpacity(0.0)
         self.setPen(QPen(Qt.PenStyle.NoPen))
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemHasNoContents)
+        self._on_changed = on_changed  # drawn by OverlayLayer
 
         self._label_signal = label_signal
-        self._pixmap = QPixmap()
+        self._raster = LazyImageBuffer()  # for drawing and fast pixels fetch
         self._sam_mode = False
-        self._img = None  # QImage to fetch color from
-        self._np_img = None  # np array for fast pixels fetch
+        self._instances = []  # instance masks (RLE) from the sidecar file
+        self._bboxes = np.zeros((0, 4), dtype=np.int64)
+        self._run_ends = {}  # cumulative RLE counts, built lazily per instance
+
+    def set_image(self, path: str, lazy: bool = False):
+        r = self.parentItem().full_rect()
+        self.setRect(QRectF(r))
+        self._raster.load(path, lazy=lazy)
+        self._load_instances(get_instances_path(Path(path)))
+        self._changed()
 
-    def set_image(self, path: str):
-        r = self.parentItem().pixmap().rect()
+    def set_array(
+        self,
+        labeled: np.ndarray,
+        instances: list[dict],
+        path: str | None = None,
+        saving: Future | None = None,
+    ):
+        # same pixels as decoding the saved PNG: gray (id, id, id), opaque.
+        # `saving` is the pending write of `path`, if any
+        r = self.parentItem().full_rect()
         self.setRect(QRectF(r))
-        self._pixmap.load(path)
-        self._update_img()
-
-    def _update_img(self):
-        image = self._pixmap.toImage()
-        buffer = image.bits()
-        buffer.setsize(image.byteCount())
-        np_img = np.frombuffer(buffer, dtype=np.uint8)
-        np_img = np_img.reshape((image.height(), image.width(), 4))
-        self._img = image
-        self._np_img = np_img
+        array = np.empty(labeled.shape + (4,), dtype=np.uint8)
+        array[:, :, :3] = labeled[:, :, None]
+        array[:, :, 3] = 255
+        self._raster.set(ImageBuffer(array), path, saving)
+        self._set_instances(instances)
+        self._changed()
+
+    def _load_instances(self, path: Path | None):
+        # a missing or unreadable sidecar falls back to color picking
+        try:
+            instances = load_instances(path) if path else []
+        except (OSError, ValueError, KeyError) as e:
+            if path.exists():
+                logger.warning("ignored SAM instances %s: %s", path.name, e)
+            instances = []
+        self._set_instances(instances)
+
+    def _set_instances(self, instances: list[dict]):
+        self._instances = instances
+        self._bboxes = np.array(
+            [inst["bbox"] for inst in self._instances], dtype=np.int64
+        ).reshape(-1, 4)
+        self._run_ends = {}
+
+    def _find_instance(self, x: int, y: int) -> int | None:
+        bx, by, bw, bh = self._bboxes.T
+        hits = np.flatnonzero((bx <= x) & (x < bx + bw) & (by <= y) & (y < by + bh))
+
+        # 重なっている場合は面積の小さいインスタンスを優先
+        for i in sorted(hits, key=lambda i: bw[i] * bh[i]):
+            if i not in self._run_ends:
+                self._run_ends[i] = np.cumsum(self._instances[i]["rle"])
+            if rle_contains(self._run_ends[i], (y - by[i]) * bw[i] + (x - bx[i])):
+                return int(i)
+        return None
+
+    def _instance_pixels(self, index: int) -> np.ndarray:
+        x, y, w, h = self._bboxes[index]
+        ys, xs = np.nonzero(decode_rle(self._instances[index]["rle"], (h, w)))
+        return np.column_stack((xs + x, ys + y))
 
     def clear(self):
-        r = self.parentItem().pixmap().rect()
+        r = self.parentItem().full_rect()
         self.setRect(QRectF(r))
-        self._pixmap = QPixmap(r.size())
-        self._pixmap.fill(Qt.GlobalColor.transparent)
-        self.update()  # to make changes be visible instantly
+        self._raster.load(None)
+        self._load_instances(None)
+        self._changed()
+
+    def overlay_source(self) -> tuple[QImage | None, float]:
+        buffer = self._raster.buffer
+        return (buffer.qimage if buffer is not None else None), self._raster.scale
+
+    def _changed(self):
+        if self._on_changed is not None:
+            self._on_changed(None)
+
+    def memory_bytes(self) -> int:
+        rle_bytes = sum(len(inst["rle"]) for inst in self._instances) * 8
+        run_ends_bytes = sum(r.nbytes for r in self._run_ends.values())
+        return self._raster.nbytes + rle_bytes + run_ends_bytes
+
+    def release_raster(self):
+        buffer = self._raster.buffer
+        self._raster.release()
+        if self._raster.buffer is not buffer:
+            self._changed()
 
-    def paint(self, painter, option, widget=None):
-        super().paint(painter, option, widget)
-        painter.save()
-        painter.drawPixmap(QPoint(), self._pixmap)
-        painter.restore()
+    def materialize_raster(self, scale: float = 1.0):
+        buffer = self._raster.buffer
+        self._raster.materialize(scale)
+        if self._raster.buffer is not buffer:
+            self._changed()
 
     def handle_click(self, pos: QPointF):
-        if not self._sam_mode or not self._img:
+        if not self._sam_mode:
             return
         x = int(pos.x())
         y = int(pos.y())
-        pc = self._img.pixelColor(x, y)
-        print(f"pixel_color: ({pc.red()}, {pc.green()}, {pc.blue()})")
-        if pc.red() == pc.green() == pc.blue() == 0:
+        if self._instances:
+            index = self._find_instance(x, y)
+            if index is not None:
+                self._label_signal.emit(self._instance_pixels(index))
+            return
+
+        buffer = self._raster.full()
+        if buffer is None:
+            return
+        if not (0 <= x < buffer.width and 0 <= y < buffer.height):
+            return
+        b, g, r, _ = buffer.array[y, x]
+        print(f"pixel_color: ({r}, {g}, {b})")
+        if r == g == b == 0:
             return
-        ids = np.where((self._np_img[:, :, :3] == pc.getRgb()[:3]).all(axis=2))
+        packed = buffer.packed
+        ids = np.nonzero(packed == packed[y, x])
         pixels = np.column_stack((ids[1], ids[0]))
         self._label_signal.emit(pixels)
 
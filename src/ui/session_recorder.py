@@ -0,0 +1,169 @@
+import gzip
+import logging
+import struct
+import time
+from contextlib import ExitStack
+from pathlib import Path
+
+from PyQt5.QtCore import QEvent, QObject
+
+# seconds since start, event type, 4 event-specific ints
+RECORD = struct.Struct("<dBiiii")
+MAGIC = b"ISATREC1"
+
+logger = logging.getLogger(__name__)
+
+MOUSE_PRESS = 1  # x, y, button, modifiers (viewport coordinates)
+MOUSE_MOVE = 2  # x, y, buttons, modifiers
+MOUSE_RELEASE = 3  # x, y, button, modifiers
+WHEEL = 4  # x, y, angle delta y, modifiers
+KEY_PRESS = 5  # key, modifiers
+SHORTCUT = 6  # key of the QShortcut that fired
+VIEW = 7  # scale * 1e6, horizontal scroll, vertical scroll
+SAMPLE = 8  # byte length of the image name that follows the record
+SAM_MODE = 9  # on
+FILL_MODE = 10  # on
+WINDOW = 11  # width, height
+SAM_RUN = 12  # Run SAM button
+DIALOG = 13  # button a question was answered with
+
+EVENT_NAMES = {
+    MOUSE_PRESS: "mouse_press",
+    MOUSE_MOVE: "mouse_move",
+    MOUSE_RELEASE: "mouse_release",
+    WHEEL: "wheel",
+    KEY_PRESS: "key_press",
+    SHORTCUT: "shortcut",
+    VIEW: "view",
+    SAMPLE: "sample",
+    SAM_MODE: "sam_mode",
+    FILL_MODE: "fill_mode",
+    WINDOW: "window",
+    SAM_RUN: "sam_run",
+    DIALOG: "dialog",
+}
+
+_MOUSE_TYPES = {
+    QEvent.Type.MouseButtonPress: MOUSE_PRESS,
+    QEvent.Type.MouseMove: MOUSE_MOVE,
+    QEvent.Type.MouseButtonRelease: MOUSE_RELEASE,
+}
+
+
+def read_session(path: Path) -> list[tuple]:
+    # [(t, type, a, b, c, d, name or None)], a torn tail is ignored
+    chunks = []
+    with gzip.open(path, "rb") as f:
+        try:
+            while chunk := f.read(1 << 16):
+                chunks.append(chunk)
+        except EOFError:
+            pass  # the app did not exit cleanly
+    data = b"".join(chunks)
+    if not data.startswith(MAGIC):
+        raise ValueError(f"{path} is not a session recording")
+
+    events = []
+    offset = len(MAGIC)
+    while offset + RECORD.size <= len(data):
+        t, kind, a, b, c, d = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        name = None
+        if kind == SAMPLE:
+            if offset + a > len(data):
+                break
+            name = data[offset : offset + a].decode()
+            offset += a
+        events.append((t, kind, a, b, c, d, name))
+    return events
+
+
+class SessionRecorder(QObject):
+    """Writes the annotator's input stream to a compact gzip log.
+
+    Mouse and wheel events are taken from the graphics view's viewport,
+    keys and resizes from the main window. View state (zoom and scroll) is
+    written whenever it changed before an input event, so a replay does not
+    depend on toolbar clicks or window-manager behaviour.
+    """
+
+    def __init__(self, path: Path, main_window, graphics_view):
+        super().__init__(main_window)
+        self.path = path
+        self._files = ExitStack()  # closed by close()
+        self._file = self._files.enter_context(gzip.GzipFile(path, "wb"))
+        self._file.write(MAGIC)
+        self._start = time.perf_counter()
+        self._view = graphics_view
+        self._viewport = graphics_view.viewport()
+        self._main_window = main_window
+        self._last_view = None
+
+        self._write(WINDOW, main_window.width(), main_window.height())
+        self._viewport.installEventFilter(self)
+        main_window.installEventFilter(self)
+
+    def _write(self, kind: int, a: int = 0, b: int = 0, c: int = 0, d: int = 0):
+        if self._file is None:
+            return
+        t = time.perf_counter() - self._start
+        self._file.write(RECORD.pack(t, kind, a, b, c, d))
+
+    def _write_view(self):
+        view = (
+            round(self._view.transform().m11() * 1e6),
+            self._view.horizontalScrollBar().value(),
+            self._view.verticalScrollBar().value(),
+        )
+        if view != self._last_view:
+            self._last_view = view
+            self._write(VIEW, *view)
+
+    def eventFilter(self, obj, event) -> bool:
+        # unaccepted events propagate to the window as well, so each kind of
+        # event is only taken from the object it was first delivered to
+        kind = _MOUSE_TYPES.get(event.type())
+        if obj is self._viewport and kind is not None:
+            self._write_view()
+            buttons = event.buttons() if kind == MOUSE_MOVE else event.button()
+            self._write(
+                kind, event.x(), event.y(), int(buttons), int(event.modifiers())
+            )
+        elif obj is self._viewport and event.type() == QEvent.Type.Wheel:
+            self._write_view()
+            pos = event.pos()
+            self._write(
+                WHEEL, pos.x(), pos.y(), event.angleDelta().y(), int(event.modifiers())
+            )
+        elif obj is self._main_window and event.type() == QEvent.Type.Resize:
+            self._write(WINDOW, event.size().width(), event.size().height())
+        elif obj is self._main_window and event.type() == QEvent.Type.KeyPress:
+            self._write(KEY_PRESS, event.key(), int(event.modifiers()))  # repeats too
+        return False  # only observe
+
+    def record_shortcut(self, key: int):
+        self._write(SHORTCUT, key)
+
+    def record_sample(self, name: str):
+        encoded = name.encode()
+        self._write(SAMPLE, len(encoded))
+        if self._file is not None:
+            self._file.write(encoded)
+
+    def record_sam_mode(self, on: bool):
+        self._write(SAM_MODE, int(on))
+
+    def record_fill_mode(self, on: bool):
+        self._write(FILL_MODE, int(on))
+
+    def record_sam_run(self):
+        self._write(SAM_RUN)
+
+    def record_dialog(self, button: int):
+        self._write(DIALOG, button)
+
+    def close(self):
+        if self._file is not None:
+            self._files.close()
+            self._file = None
+            logger.info("session recorded to %s", self.path)
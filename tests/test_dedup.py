@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from src.logic.dedup import DuplicateIndex, HammingIndex
+
+
+def _brute_force(hashes: np.ndarray, queries: np.ndarray, radius: int) -> set:
+    distances = np.bitwise_count(queries[:, None] ^ hashes[None, :])
+    return {
+        (int(q), int(e), int(distances[q, e]))
+        for q, e in zip(*np.nonzero(distances <= radius))
+    }
+
+
+def _near(rng, base: np.ndarray, flips: int) -> np.ndarray:
+    # copies of `base` with `flips` random bits flipped
+    out = base.copy()
+    for i in range(len(out)):
+        for bit in rng.choice(64, flips, replace=False):
+            out[i] ^= np.uint64(1) << np.uint64(bit)
+    return out
+
+
+@pytest.mark.parametrize("n", [1, 50, 5000])
+@pytest.mark.parametrize("radius", [0, 3, 8, 12])
+def test_search_matches_brute_force(n, radius):
+    rng = np.random.default_rng(n + radius)
+    hashes = rng.integers(0, 2**64, n, dtype=np.uint64)
+    queries = np.concatenate(
+        [
+            hashes[:20],
+            _near(rng, hashes[:20], radius),
+            _near(rng, hashes[:20], radius + 1),
+            rng.integers(0, 2**64, 20, dtype=np.uint64),
+        ]
+    )
+
+    q, e, d = HammingIndex(hashes).search(queries, radius)
+    found = set(zip(q.tolist(), e.tolist(), d.tolist()))
+    assert len(found) == len(q)  # each pair once
+    assert found == _brute_force(hashes, queries, radius)
+
+
+def test_search_without_matches():
+    index = HammingIndex(np.array([0], dtype=np.uint64))
+    q, e, d = index.search(np.array([2**64 - 1], dtype=np.uint64), 8)
+    assert len(q) == len(e) == len(d) == 0
+
+
+def test_duplicate_index_recent_entries_and_removal(tmp_path, monkeypatch):
+    monkeypatch.setattr("src.logic.dedup.REBUILD_AFTER", 2)
+    (tmp_path / "images").mkdir()
+    index = DuplicateIndex(tmp_path / "index.npz", tmp_path)
+    values = {f"{i}.png": (i * 0x9E3779B97F4A7C15) % 2**64 for i in range(5)}
+    for name, value in values.items():
+        path = tmp_path / "images" / name
+        path.write_bytes(b"")
+        index.add(path, value)
+
+    # still scanned linearly, then folded into the index
+    assert index.query(values["3.png"] ^ 0b101, 2) == [("images/3.png", 2)]
+    index.compact()
+    assert not index._recent
+    assert index.query(values["3.png"] ^ 0b101, 2) == [("images/3.png", 2)]
+
+    index.remove(tmp_path / "images" / "3.png")
+    assert index.query(values["3.png"], 2) == []
+
+    index.save()
+    reloaded = DuplicateIndex(tmp_path / "index.npz", tmp_path)
+    assert len(reloaded) == 4
+
+
+def test_clusters(tmp_path):
+    index = DuplicateIndex(tmp_path / "index.npz", tmp_path)
+    index._entries = {
+        "a": (0.0, 0b0000),
+        "b": (0.0, 0b0011),  # 2 from a
+        "c": (0.0, 0b1111),  # 2 from b, 4 from a
+        "d": (0.0, 0xFFFF0000),
+    }
+    assert index.clusters(2) == [["a", "b", "c"]]
+    assert index.clusters(1) == []
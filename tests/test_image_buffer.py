@@ -0,0 +1,47 @@
+import numpy as np
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QColor, QImage, QPainter
+
+from src.ui.image_buffer import ImageBuffer
+
+
+def test_painting_writes_into_the_array():
+    buffer = ImageBuffer.blank(8, 6)
+    assert buffer.array.shape == (6, 8, 4) and not buffer.array.any()
+
+    painter = QPainter(buffer.qimage)
+    painter.fillRect(2, 1, 3, 2, QColor("#FF8000"))
+    painter.end()
+
+    # opaque pixels are the QColor.rgba() word, BGRA in memory
+    assert buffer.packed[1, 2] == QColor("#FF8000").rgba() == 0xFFFF8000
+    np.testing.assert_array_equal(buffer.array[1, 2], [0x00, 0x80, 0xFF, 0xFF])
+    assert np.count_nonzero(buffer.packed) == 6
+
+
+def test_from_qimage_premultiplies():
+    image = QImage(2, 1, QImage.Format.Format_ARGB32)
+    image.setPixelColor(0, 0, QColor(200, 100, 50, 128))
+    image.setPixelColor(1, 0, QColor(200, 100, 50, 0))
+
+    buffer = ImageBuffer.from_qimage(image)
+    b, g, r, a = (int(v) for v in buffer.array[0, 0])
+    assert a == 128
+    assert (r, g, b) == (
+        round(200 * 128 / 255),
+        round(100 * 128 / 255),
+        round(50 * 128 / 255),
+    )
+    assert buffer.packed[0, 1] == 0  # fully transparent is all zero
+
+
+def test_save_and_load_round_trip(tmp_path):
+    array = np.zeros((4, 5, 4), dtype=np.uint8)
+    array[1:3, 2:4] = (0, 0, 255, 255)  # opaque red
+    path = tmp_path / "label.png"
+    assert ImageBuffer(array).save(path)
+
+    loaded = ImageBuffer.load(str(path))
+    np.testing.assert_array_equal(loaded.array, array)
+    assert loaded.qimage.pixelColor(2, 1) == QColor(Qt.GlobalColor.red)
+    assert ImageBuffer.load(str(tmp_path / "missing.png")) is None
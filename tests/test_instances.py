@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from src.logic.instances import decode_rle, encode_instance, encode_rle, rle_contains
+
+
+@pytest.mark.parametrize(
+    "mask",
+    [
+        np.zeros((3, 4), dtype=bool),
+        np.ones((3, 4), dtype=bool),
+        np.eye(4, dtype=bool),
+        np.array([[1, 1, 0, 1], [0, 0, 1, 1]], dtype=bool),
+    ],
+)
+def test_rle_round_trip(mask):
+    counts = encode_rle(mask)
+    assert sum(counts) == mask.size
+    np.testing.assert_array_equal(decode_rle(counts, mask.shape), mask)
+
+
+def test_rle_starts_with_background_run():
+    assert encode_rle(np.array([[1, 1, 0]], dtype=bool)) == [0, 2, 1]
+    assert encode_rle(np.array([[0, 1, 1]], dtype=bool)) == [1, 2]
+
+
+def test_rle_contains_matches_mask():
+    rng = np.random.default_rng(0)
+    mask = rng.random((17, 23)) < 0.3
+    run_ends = np.cumsum(encode_rle(mask))
+    found = [rle_contains(run_ends, i) for i in range(mask.size)]
+    np.testing.assert_array_equal(found, mask.ravel())
+
+
+def test_encode_instance_crops_to_bbox():
+    mask = np.zeros((10, 12), dtype=bool)
+    mask[2:5, 3:9] = True
+    mask[4, 3] = False
+    instance = encode_instance(2, 0.91234, mask, x0=100, y0=50)
+    assert instance["bbox"] == [103, 52, 6, 3]
+    assert instance["score"] == 0.9123
+    np.testing.assert_array_equal(decode_rle(instance["rle"], (3, 6)), mask[2:5, 3:9])
+    assert encode_instance(1, 0.5, np.zeros((4, 4), dtype=bool)) is None
@@ -0,0 +1,95 @@
+import os
+import socket
+import subprocess
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+from src.logic.recovery import RecoveryJournal, SessionInUseError
+
+RED = 0xFFFF0000
+GREEN = 0xFF00FF00
+
+
+def _tile(h: int, w: int, value: int) -> np.ndarray:
+    return np.full((h, w), value, dtype=np.uint32)
+
+
+def _crash(journal: RecoveryJournal):
+    # flush the writer, then leave the lock of a process that is gone
+    journal._executor.shutdown(wait=True)
+    dead = subprocess.Popen([sys.executable, "-c", ""])
+    dead.wait()
+    journal.lock_path.write_text(f"{dead.pid} {socket.gethostname()}")
+
+
+def _read_packed(path) -> np.ndarray:
+    label = cv2.imread(str(path), cv2.IMREAD_UNCHANGED)
+    return np.ascontiguousarray(label).view(np.uint32)[:, :, 0]
+
+
+def test_replay_applies_tiles_over_the_saved_label(tmp_path):
+    label_dir = tmp_path / "labels"
+    label_dir.mkdir()
+    saved = np.zeros((32, 48, 4), dtype=np.uint8)
+    saved[0:4, 0:4] = (0, 255, 0, 255)  # green, untouched by the journal
+    cv2.imwrite(str(label_dir / "a.png"), saved)
+
+    journal = RecoveryJournal(tmp_path / "recovery")
+    journal.start_session()
+    journal.append("a", (32, 48), [(16, 0, _tile(16, 16, RED))])
+    journal.append("a", (32, 48), [(16, 8, _tile(8, 8, GREEN))])  # later wins
+    journal.append("b", (8, 8), [(0, 0, _tile(8, 8, RED))])  # no saved label
+    _crash(journal)
+
+    restarted = RecoveryJournal(tmp_path / "recovery")
+    assert restarted.crashed
+    restarted.start_session()
+    assert restarted.replay_all(label_dir) == ["a", "b"]
+    assert not list((tmp_path / "recovery").glob("*.recovery"))
+
+    packed = _read_packed(label_dir / "a.png")
+    assert packed[0, 0] == GREEN
+    assert packed[0, 16] == RED and packed[8, 16] == GREEN and packed[20, 20] == 0
+    assert (_read_packed(label_dir / "b.png") == RED).all()
+    restarted.end_session()
+
+
+def test_torn_tail_is_ignored(tmp_path):
+    journal = RecoveryJournal(tmp_path / "recovery")
+    journal.start_session()
+    journal.append("a", (8, 8), [(0, 0, _tile(4, 4, RED))])
+    journal.append("a", (8, 8), [(4, 4, _tile(4, 4, RED))])
+    _crash(journal)
+    path = tmp_path / "recovery" / "a.recovery"
+    os.truncate(path, path.stat().st_size - 3)
+
+    restarted = RecoveryJournal(tmp_path / "recovery")
+    restarted.start_session()
+    restarted.replay_all(tmp_path)
+    packed = _read_packed(tmp_path / "a.png")
+    assert packed[0, 0] == RED and packed[4, 4] == 0
+    restarted.end_session()
+
+
+def test_clean_exit_is_not_a_crash(tmp_path):
+    journal = RecoveryJournal(tmp_path / "recovery")
+    journal.start_session()
+    journal.end_session()
+    assert not RecoveryJournal(tmp_path / "recovery").crashed
+
+
+def test_live_session_is_refused_and_left_alone(tmp_path):
+    journal = RecoveryJournal(tmp_path / "recovery")
+    journal.start_session()
+    journal.append("a", (8, 8), [(0, 0, _tile(8, 8, RED))])
+    journal._executor.shutdown(wait=True)
+
+    other = RecoveryJournal(tmp_path / "recovery")
+    assert not other.crashed
+    with pytest.raises(SessionInUseError):
+        other.start_session()
+    assert (tmp_path / "recovery" / "a.recovery").exists()
+    journal.end_session()
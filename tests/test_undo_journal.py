@@ -0,0 +1,95 @@
+import numpy as np
+
+from src.logic.undo_journal import UndoJournal
+
+
+def _stroke(packed: np.ndarray, x0: int, y0: int, x1: int, y1: int, value: int):
+    packed[y0:y1, x0:x1] = value
+    return x0, y0, x1, y1
+
+
+def _apply(packed: np.ndarray, patch):
+    x, y, pixels = patch
+    h, w = pixels.shape
+    packed[y : y + h, x : x + w] = pixels
+
+
+def test_undo_and_redo_restore_each_state(tmp_path):
+    journal = UndoJournal(tmp_path, max_bytes=1 << 20)
+    packed = np.zeros((40, 60), dtype=np.uint32)
+    journal.open("a", packed)
+
+    states = [packed.copy()]
+    for i, rect in enumerate([(5, 5, 20, 15), (10, 8, 50, 30), (0, 0, 3, 3)]):
+        journal.record(packed, _stroke(packed, *rect, 0xFF000000 + i + 1))
+        states.append(packed.copy())
+
+    for expected in reversed(states[:-1]):
+        _apply(packed, journal.undo())
+        np.testing.assert_array_equal(packed, expected)
+    assert journal.undo() is None
+
+    for expected in states[1:]:
+        _apply(packed, journal.redo())
+        np.testing.assert_array_equal(packed, expected)
+    assert journal.redo() is None
+
+
+def test_patch_covers_only_changed_pixels(tmp_path):
+    journal = UndoJournal(tmp_path, max_bytes=1 << 20)
+    packed = np.zeros((40, 60), dtype=np.uint32)
+    journal.open("a", packed)
+    packed[12:14, 30:33] = 0xFFFF0000
+    journal.record(packed, None)  # whole label may have changed
+
+    x, y, before = journal.undo()
+    assert (x, y, before.shape) == (30, 12, (2, 3))
+    assert not before.any()
+
+
+def test_history_survives_reopening(tmp_path):
+    packed = np.zeros((16, 16), dtype=np.uint32)
+    journal = UndoJournal(tmp_path, max_bytes=1 << 20)
+    journal.open("a", packed)
+    journal.record(packed, _stroke(packed, 0, 0, 4, 4, 0xFF00FF00))
+    journal.record(packed, _stroke(packed, 8, 8, 12, 12, 0xFF0000FF))
+    _apply(packed, journal.undo())
+
+    # a new branch after an undo drops the undone stroke, also on disk
+    journal.record(packed, _stroke(packed, 2, 2, 6, 6, 0xFFFFFFFF))
+    expected = packed.copy()
+
+    reopened = UndoJournal(tmp_path, max_bytes=1 << 20)
+    reopened.open("a", packed)
+    _apply(packed, reopened.undo())
+    _apply(packed, reopened.undo())
+    assert not packed.any()
+    assert reopened.undo() is None
+    _apply(packed, reopened.redo())
+    _apply(packed, reopened.redo())
+    np.testing.assert_array_equal(packed, expected)
+
+
+def test_torn_record_is_dropped(tmp_path):
+    packed = np.zeros((16, 16), dtype=np.uint32)
+    journal = UndoJournal(tmp_path, max_bytes=1 << 20)
+    journal.open("a", packed)
+    journal.record(packed, _stroke(packed, 0, 0, 4, 4, 0xFF00FF00))
+    with open(tmp_path / "a.journal", "ab") as f:
+        f.write(b"S\x00\x00")  # crash in the middle of the next record
+
+    reopened = UndoJournal(tmp_path, max_bytes=1 << 20)
+    reopened.open("a", packed)
+    x, y, before = reopened.undo()
+    assert (x, y) == (0, 0) and not before.any()
+
+
+def test_history_of_another_size_is_ignored(tmp_path):
+    journal = UndoJournal(tmp_path, max_bytes=1 << 20)
+    packed = np.zeros((40, 60), dtype=np.uint32)
+    journal.open("a", packed)
+    journal.record(packed, _stroke(packed, 30, 20, 60, 40, 0xFF00FF00))
+
+    # same stem, smaller image: the patch would not fit
+    journal.open("a", np.zeros((10, 10), dtype=np.uint32))
+    assert journal.undo() is None